@@ -5,6 +5,11 @@ from enum import Enum
 
 import ptyprocess
 import utils
+from reactor import Reactor
+from ringbuffer import RingBuffer
+from matcher import (ExpectMatcher, MultiMatcher, PromptMatcher,
+                     compile_prompt_patterns,
+                     PROBE_ERROR, PROBE_ESCAPE)
 from utils import BYTES, STR
 from command import *
 from globs import *
@@ -18,68 +23,167 @@ class AgentWrapper(object):
     ttyfork_probe_command = ('telnet', 'ssh')
     CR = '\r'
     LF = '\n'
+    ptyclass = ptyprocess.PtyProcess   # tty of the agent's local shell
 
-    def __init__(self, logfile=None):
+    def __init__(self, logfile=None, bufsize=None, env=None):
         self.prompt = DEFAULT_LOCAL_PS1
         self.logfile = logfile
-        self.post_read = ''
+        self.env = env              # extra environment of the agent's local shell
         self.tty = None
+        self.this_session = None    # console session the agent drives, shown in error info
+        self.reactor = self.new_reactor()   # wakes the agent on tty readability and timeouts
+        # tty output capture, read into directly by tty
+        self.outbuf = RingBuffer(bufsize) if bufsize else RingBuffer()
+        self.log_offset = 0         # outbuf offset that has been logged up to
+        self.expect_matcher = None  # streaming matchers of the probing command
+        self.probe_matcher = None
+        self.prompt_matcher = None
+
+    def new_reactor(self):
+        return Reactor()
 
     def log(self, data=''):
         nsent = 0
         if self.logfile and not self.logfile.closed:
-            while data:
-                n = self.logfile.write(data)
-                nsent += n
-                data = data[n:]
+            if isinstance(data, str):
+                while data:
+                    n = self.logfile.write(data)
+                    nsent += n
+                    data = data[n:]
+            elif data:  # bytes-like views of outbuf go to the binary layer directly
+                self.logfile.flush()
+                nsent = self.logfile.buffer.write(data)
             self.logfile.flush()
 
         return nsent
 
+    def log_outbuf(self):
+        '''log the outbuf data that hasn't been logged yet'''
+        end = self.outbuf.tell()
+        if end > self.log_offset:
+            self.log(utils.strip_ansi_escapes(self.outbuf.view(self.log_offset, end)))
+            self.log_offset = end
+
+    def read_tty(self):
+        '''read available tty output into outbuf, return bytes count'''
+        n = self.tty.read_all_into(self.outbuf)
+        self.log_outbuf()
+        return n
+
     def flush(self):
-        if self.tty:
-            out = self.post_read + STR(self.tty.read_all_nonblocking())
-            self.post_read = ''
-            out = utils.strip_ansi_escapes(out)
-            self.log(out)
+        if self.tty and not self.tty.closed:
+            while self.read_tty(): pass
 
     def close_handler(self):
         if self.logfile and not self.logfile.closed:
             self.logfile.flush()
             self.logfile.close()
 
-    def _expect(self, out, expect):
+    def _expect(self, matcher):
         """Expect each item in expect list, return False only if all items are found."""
-        if not expect or not out: return False
-
-        expects = expect if isinstance(expect, type(())) else (expect,)
-        raise_up = False
-
-        for exp in expects:
-            pos = utils.magic_search(exp, out, find=True)
-            if pos < 0:
-                raise_up = True
-                break
-            out = out[pos+len(exp):]
+        if matcher is None or not matcher.patterns: return False
 
-        return raise_up
+        return not matcher.feed(self.outbuf)
 
-    def _escape(self, out, escape):
+    def _escape(self, matcher):
         """Escape each item in escape list, return False if any of items is found."""
-        if not escape or not out: return False
-
-        escapes = escape if isinstance(escape, type(())) else (escape,)
-        raise_up = False
-
-        for esc in escapes:
-            if utils.magic_search(esc, out):
-                raise_up = True
-                break
-
-        return raise_up
-
-    def probe_read(self, command):
-        
+        if matcher is None: return False
+
+        matcher.feed(self.outbuf)
+        return matcher.hit(PROBE_ESCAPE) is not None
+
+    def _errmsg(self, matcher):
+        """Return the shell error message found in output, None if no error."""
+        if matcher is None: return None
+
+        matcher.feed(self.outbuf)
+        return matcher.hit(PROBE_ERROR)
+
+    def _prompted(self, matcher):
+        '''Check if output ends with a shell prompt'''
+        return matcher.prompted(self.outbuf) is not None
+
+    def spawn_tty(self):
+        '''start the local shell, prompting with the agent's prompt'''
+        env = dict(os.environ, PS1=self.prompt)
+        if self.env: env.update(self.env)
+        self.tty = self.ptyclass.spawn(list(LOCAL_SHELL), env=env, echo=False)
+        return self.tty
+
+    def open_tty(self):
+        '''start the local shell and wait for its prompt'''
+        self.spawn_tty()
+        self.probe_read(ShellCmd(('',)), prompt_only=True)
+
+    def send_command(self, command):
+        '''Send a command line to tty, command is a ShellCmd or a string'''
+        data = command.plan.data if isinstance(command, ShellCmd) else BYTES(command)
+        return self.tty.write(data + BYTES(self.CR))
+
+    def check_output(self, command, output):
+        '''Return the probed output of command, raise ExpectFailure if it has a
+        shell error message or misses expects, unless an escape was found'''
+        if self.probe_matcher.hit(PROBE_ESCAPE) is not None:
+            return output
+
+        errmsg = self._errmsg(self.probe_matcher)
+        if errmsg is not None and command.args[0].split(' ')[0] not in ERR_BYPASS_CMDS:
+            raise ExpectFailure('Shell error message: %s' %(STR(errmsg)),
+                                prompt=self.prompt, output=output)
+        if self.expect_matcher and not self.expect_matcher.done:
+            raise ExpectFailure('Expects not found: %s' %(command),
+                                prompt=self.prompt, output=output)
+        return output
+
+    def start_probe(self, command, begin, prompt_only=False):
+        '''Set up the matchers probing the output of command from outbuf offset
+        begin, return the probe timeout'''
+        plan = command.plan     # patterns are resolved at parse time, only matcher states are new
+        self.expect_matcher = ExpectMatcher(plan.expects, begin) if plan.expects else None
+        # error messages and escapes are all probed in one pass, prompts
+        # only in the tail of the last line
+        self.probe_matcher = MultiMatcher(plan.probe, begin)
+        self.prompt_matcher = PromptMatcher(compile_prompt_patterns(self.prompt), begin)
+        return plan.timeout if not prompt_only else SESSION_PROMPT_RETRY_TIMEOUT
+
+    def probe_step(self, command, begin, prompt_only=False):
+        '''Read the tty output available now into the matchers, return the output
+        from begin once an escape or the prompt shows up, None until then'''
+        if not self.read_tty():
+            if self.tty.eof():  # readable but nothing to read, tty is gone
+                raise PtyProcessError('TTY closed unexpectedly: %s' %(command))
+            return None
+        # matchers keep their own resume offsets, feeding them per read
+        # scans every byte once however long the output grows
+        if not prompt_only:
+            if self.expect_matcher: self.expect_matcher.feed(self.outbuf)
+            if self._escape(self.probe_matcher):
+                return STR(self.outbuf.view(begin))
+
+        if self._prompted(self.prompt_matcher):
+            return STR(self.outbuf.view(begin))
+        return None
+
+    def probe_read(self, command, begin=None, prompt_only=False):
+        '''Read tty output until the shell prompt shows up, the agent sleeps in the
+        reactor and wakes only when tty is readable or command timeout expires.
+        Output is captured in outbuf from offset begin, by default from now on.
+        Escapes end the probe early, only the prompt is probed if prompt_only.'''
+        tty = self.tty
+        tty.attach_reactor(self.reactor)
+        if begin is None: begin = self.outbuf.tell()
+        timeout = self.start_probe(command, begin, prompt_only)
+        t_end = time.monotonic() + timeout if timeout is not None else None
+
+        while True:
+            wait = max(t_end - time.monotonic(), 0.0) if t_end is not None else None
+            if not tty.wait_readable(wait):
+                raise TimeoutError('Command exceeded time limit: %rsec' %(timeout),
+                                   prompt=self.prompt, output=STR(self.outbuf.view(begin)))
+
+            output = self.probe_step(command, begin, prompt_only)
+            if output is not None:
+                return output
 
     def exec(self, command):
         if isinstance(command, BuiltinCmd):
@@ -89,11 +193,14 @@ class AgentWrapper(object):
                 raise BuiltinCmdError('Builtin Command Error: %s, no EXCE method' %(command.args[0]))
 
         if isinstance(command, ShellCmd):
-            tty = self.tty
-            if tty and not tty.closed:
-                if not tty.isalive():
-                    raise 
+            if self.tty is None or self.tty.closed:
+                self.open_tty()
+            elif not self.tty.isalive():
+                raise PtyProcessError('TTY process is dead: %s' %(self.tty))
 
+            begin = self.outbuf.tell()
+            self.send_command(command)
+            return self.check_output(command, self.probe_read(command, begin))
 
     def close_tty(self):
         if self.tty and not self.tty.closed:
@@ -114,6 +221,7 @@ class AgentWrapper(object):
         self.log('\n\n' + str(self) + '\n')
         self.close_tty()
         self.close_handler()
+        self.reactor.close()
 
     def __str__(self):
         header = 'AGENT INFO:'
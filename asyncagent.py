@@ -0,0 +1,311 @@
+import os
+import errno
+import asyncio
+import time
+
+import ptyprocess
+import utils
+from agent import AgentWrapper
+from sequence import LoopInterpreter, get_parsed_seqreader
+from utils import BYTES, STR
+from command import *
+from globs import *
+from errors import *
+
+
+ASYNC_SESSION_BUFFER = 64*1024  # output ring per session, a session only probes its recent output
+
+
+class AsyncPtyProcess(ptyprocess.PtyProcess):
+    """PtyProcess driven by an asyncio event loop.
+
+    The pty fd is nonblocking and registered to the loop by add_reader only
+    while a coroutine waits on it, so one thread drives any number of ptys
+    without a reactor or an epoll fd per pty."""
+
+    def __init__(self, pid, fd):
+        super().__init__(pid, fd)
+        os.set_blocking(fd, False)
+
+    async def _wait_fd(self, add, remove, timeout=None):
+        if self.fd < 0: raise EOFError('Invalid file descriptor, %d' %(self.fd))
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        fd = self.fd
+        def ready():
+            if not waiter.done():
+                waiter.set_result(True)
+        add(fd, ready)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            remove(fd)
+
+    async def wait_readable(self, timeout=None):
+        """Wait until the pty is readable, return False if timeout expires
+        first. None timeout waits forever."""
+        loop = asyncio.get_running_loop()
+        return await self._wait_fd(loop.add_reader, loop.remove_reader, timeout)
+
+    def readinto(self, b):
+        """Read at most ``len(b)`` bytes from the pty into ``b``, never blocks.
+        Return the number of bytes read, 0 if there's nothing to read now,
+        raise :exc:`EOFError` if the terminal was closed."""
+        try:
+            n = os.readv(self.fd, (b,))
+        except BlockingIOError:
+            return 0
+        except OSError as err:
+            if err.errno != errno.EIO:
+                raise
+            n = 0   # Linux-style EOF
+        if not n:
+            self.flag_eof = True
+            raise EOFError('End Of File (EOF).')
+
+        return n
+
+    def readable_now(self):
+        return True     # the fd is nonblocking, readinto tells
+
+    async def write_async(self, data):
+        """Write bytes to the pseudoterminal, waiting for room if it's full"""
+        loop = asyncio.get_running_loop()
+        data = memoryview(data)
+        nsent = 0
+        while nsent < len(data):
+            try:
+                nsent += os.write(self.fd, data[nsent:])
+            except BlockingIOError:
+                await self._wait_fd(loop.add_writer, loop.remove_writer)
+
+        return nsent
+
+    async def close_async(self):
+        '''close() sleeps for the child to go, in a thread so other sessions go on'''
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+
+class AsyncAgent(AgentWrapper):
+    """Agent of one console session run by coroutines.
+
+    Many agents share one process and event loop: a session costs a pty, a
+    small output ring and its matchers instead of a Python process."""
+
+    ptyclass = AsyncPtyProcess
+
+    def __init__(self, name, logfile=None, env=None, bufsize=ASYNC_SESSION_BUFFER):
+        super().__init__(logfile, bufsize, env)
+        self.name = name
+        self.this_session = name
+
+    def new_reactor(self):
+        return None                 # waits are done by the event loop
+
+    async def open_tty(self):
+        '''start the session's local shell and wait for its prompt'''
+        self.spawn_tty()
+        await self.probe_read(ShellCmd(('',)), prompt_only=True)
+
+    async def send_command(self, command):
+        '''Send a command line to tty, command is a ShellCmd or a string'''
+        data = command.plan.data if isinstance(command, ShellCmd) else BYTES(command)
+        return await self.tty.write_async(data + BYTES(self.CR))
+
+    async def probe_read(self, command, begin=None, prompt_only=False):
+        '''Read tty output until the shell prompt shows up, as AgentWrapper.probe_read,
+        but the session waits in the event loop. Escapes end the probe early.'''
+        tty = self.tty
+        if begin is None: begin = self.outbuf.tell()
+        timeout = self.start_probe(command, begin, prompt_only)
+        t_end = time.monotonic() + timeout if timeout is not None else None
+
+        while True:
+            wait = max(t_end - time.monotonic(), 0.0) if t_end is not None else None
+            if not await tty.wait_readable(wait):
+                raise TimeoutError('Command exceeded time limit: %rsec' %(timeout),
+                                   prompt=self.prompt, output=STR(self.outbuf.view(begin)))
+
+            output = self.probe_step(command, begin, prompt_only)
+            if output is not None:
+                return output
+
+    async def exec(self, command):
+        if isinstance(command, BuiltinCmd):
+            handler = self.builtins.get(command.args[0])
+            if handler is None:
+                raise BuiltinCmdError('Builtin Command Error: %s, not supported by async engine' %(command.args[0]))
+            return await handler(self, command)
+
+        if isinstance(command, ShellCmd):
+            if self.tty is None or self.tty.closed:
+                await self.open_tty()
+            elif not self.tty.isalive():
+                raise PtyProcessError('TTY process is dead: %s' %(self.tty))
+
+            begin = self.outbuf.tell()
+            await self.send_command(command)
+            return self.check_output(command, await self.probe_read(command, begin))
+
+    async def _enter(self, command):
+        return await self.exec(ShellCmd(('',)))
+
+    async def _ctrl_c(self, command):
+        if self.tty and not self.tty.closed:
+            await self.tty.write_async(b'\x03')
+        return True
+
+    async def _wait(self, command):
+        await asyncio.sleep(command.waitsec)
+        return True
+
+    async def _setprompt(self, command):
+        self.prompt = command.promptstr
+        return True
+
+    async def _close(self, command):
+        await self.close_tty()
+        return True
+
+    builtins = {
+        'ENTER': _enter,
+        'CTRL-C': _ctrl_c,
+        'WAIT': _wait,
+        'SETPROMPT': _setprompt,
+        'CLOSE': _close,
+        }
+
+    async def close_tty(self):
+        if self.tty and not self.tty.closed:
+            self.flush()
+            self.log('\n\nClose TTY ...\n\n')
+            await self.tty.close_async()
+
+        self.prompt = DEFAULT_LOCAL_PS1
+        self.tty = None
+
+    async def exit(self):
+        self.flush()
+        self.log('\n\n' + str(self) + '\n')
+        await self.close_tty()
+        self.close_handler()
+
+
+class AsyncSession(LoopInterpreter):
+    """A sequence run by an AsyncAgent, with its loop results"""
+    __slots__ = ('agent', 'sequence', 'subsequences', 'frames', 'failed',
+                 'success_loops', 'failure_loops', 'failures')
+
+    def __init__(self, agent, seqreader, loops):
+        self.agent = agent
+        self.sequence = seqreader.sequence
+        self.subsequences = seqreader.subsequences
+        self.check_commands()
+        self.frames = []
+        self.push_frame(self.sequence, loops)
+        self.failed = False         # a command of the running test loop failed
+        self.success_loops = 0
+        self.failure_loops = 0
+        self.failures = []          # (loop, error info) of failed commands
+
+    def check_commands(self):
+        '''Raise SequenceError if the sequence has builtin commands the agent
+        can't run, before any session starts'''
+        for sequence in [self.sequence] + list(self.subsequences.values()):
+            for command in sequence:
+                if isinstance(command, BuiltinCmd) and not isinstance(command, LOOP) and \
+                        command.args[0] not in self.agent.builtins:
+                    raise SequenceError('%s is not supported by async sessions: %s' %(command.args[0], ' '.join(map(str, command.args))))
+
+    def loop_done(self):
+        if self.failed: self.failure_loops += 1
+        else: self.success_loops += 1
+        self.failed = False
+
+    async def run(self):
+        '''run the loops with the loop interpreter of the sequence workers, a
+        failed command fails its loop and the session ends if STOP_ON_FAILURE
+        or the error is not a test failure'''
+        agent = self.agent
+        try:
+            while True:
+                command = self.next_command()
+                if command is None:
+                    break
+                if isinstance(command, LOOP):
+                    self.push_frame(self.subsequences[command.symbol], command.loops, command.symbol)
+                    continue
+
+                try:
+                    await agent.exec(command)
+                except Exception as error:
+                    self.failed = True
+                    self.failures.append((self.frames[0].cmplt_loops + 1, '%s: %s, Command: %s' %(
+                        type(error).__name__, error.args[0] if error.args else 'NARG', command)))
+                    if STOP_ON_FAILURE or type(error) not in (ExpectFailure, TimeoutError):
+                        self.failure_loops += 1
+                        break
+        finally:
+            await agent.exit()
+
+        return self
+
+
+class AsyncEngine(object):
+    """Run many console sessions concurrently in one process and one thread.
+
+    Every session is a coroutine waiting on its pty through the event loop,
+    at most limit sessions run at once and the others wait for a free one."""
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.sessions = []
+
+    def add_session(self, session):
+        self.sessions.append(session)
+        return session
+
+    async def _run_session(self, session, semaphore):
+        if semaphore is None:
+            return await session.run()
+        async with semaphore:
+            return await session.run()
+
+    async def run_async(self):
+        semaphore = asyncio.Semaphore(self.limit) if self.limit else None
+        return await asyncio.gather(*(self._run_session(s, semaphore) for s in self.sessions),
+                                    return_exceptions=True)
+
+    def run(self):
+        return asyncio.run(self.run_async())
+
+
+def run_async_sequences(sequence_file, loops=1, sessions=1, targets=()):
+    '''Run the sequence for loops on every session, one session per target
+    if targets are given, and print the results of the sessions'''
+    seqreader = get_parsed_seqreader(sequence_file)
+    name = utils.get_sequence_name(sequence_file)
+    targets = tuple(targets) or (None,) * sessions
+
+    engine = AsyncEngine()
+    for i, target in enumerate(targets):
+        env = {TARGET_ENV: target} if target else None
+        agent = AsyncAgent('%s#%d' %(name, i), env=env)
+        engine.add_session(AsyncSession(agent, seqreader, loops))
+
+    t_start = time.monotonic()
+    results = engine.run()
+    elapsed = time.monotonic() - t_start
+
+    print('\n%d sessions of %s in %.2fs' %(len(results), sequence_file, elapsed))
+    for session, result in zip(engine.sessions, results):
+        if isinstance(result, BaseException):
+            print('%s: %r' %(session.agent.name, result))
+            continue
+        print('%s: %d success, %d failure' %(session.agent.name, result.success_loops, result.failure_loops))
+        for loop, errinfo in result.failures:
+            print('    Loop %d: %s' %(loop, errinfo))
+
+    return results
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""Micro benchmarks of sequence parsing and command storage.
+
+Usage: python benchmark.py [name ...], runs all benchmarks by default.
+"""
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+
+import globs
+sys.path.append(globs.TOPDIR)
+
+import sequence
+import command
+import matcher
+from sequence import SequenceReader
+
+
+def synthetic_sequence(nlines, distinct=None):
+    '''Generate a sequence file of nlines shell commands, with distinct lines
+    repeated over and over if distinct is given, return the file path'''
+    fd, path = tempfile.mkstemp(suffix='.seq', prefix='bench_')
+    with os.fdopen(fd, 'w') as fp:
+        for i in range(nlines):
+            n = i % distinct if distinct else i
+            fp.write('ipmitool raw 0x30 0x%02x %d; ok, done; fail\\ msg; 30\n' %(i % 7, n))
+    return path
+
+
+def synthetic_mixed_sequence(nlines):
+    '''Generate a sequence file mixing shell and builtin commands, one line
+    out of four is a builtin, return the file path'''
+    builtins = ('WAIT 1s', 'ENTER', 'CTRL-C', 'SETPROMPT bench%d>', 'PULSE', 'CLOSE')
+    fd, path = tempfile.mkstemp(suffix='.seq', prefix='bench_')
+    with os.fdopen(fd, 'w') as fp:
+        for i in range(nlines):
+            if i % 4:
+                fp.write('ipmitool raw 0x30 0x%02x %d; ok, done; fail\\ msg; 30\n' %(i % 7, i))
+            else:
+                line = builtins[(i // 4) % len(builtins)]
+                fp.write((line %(i) if '%d' in line else line) + '\n')
+    return path
+
+
+def measure_memory(func):
+    '''Return (result, traced memory in bytes) of func()'''
+    tracemalloc.start()
+    try:
+        result = func()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, current
+
+
+def legacy_parse_lines(reader):
+    '''the sequence as a list of one command object per line, the layout
+    before CommandStore, kept as the memory baseline'''
+    commands = []
+    for seqline in reader.lines():
+        builtincmd = command.BuiltinCmd.discovery(seqline)
+        if builtincmd:
+            if builtincmd.is_seq_cmd:
+                commands.append(builtincmd)
+        else:
+            commands.append(command.ShellCmd(command.make_shellcmd_args_by_line(seqline)))
+    return commands
+
+
+def bench_command_memory(nlines=50000):
+    '''memory held by a parsed sequence, all distinct lines and 10 repeated
+    lines, as a list of commands and as a CommandStore'''
+    sequence.SEQUENCE_CACHE_ENABLED = False
+    for distinct in (None, 10):
+        path = synthetic_sequence(nlines, distinct)
+        try:
+            def parse_legacy():
+                return legacy_parse_lines(SequenceReader(path))
+            def parse():
+                reader = SequenceReader(path)
+                reader.parse_lines()
+                return reader.sequence
+            nbytes = []
+            for func in (parse_legacy, parse):
+                matcher.resolve_pattern.cache_clear()   # neither gets the other's patterns
+                matcher.compile_probe_patterns.cache_clear()
+                seq, n = measure_memory(func)
+                nbytes.append(n)
+            print('command memory: %d lines, %s distinct: list %.1f MB, store %.1f MB, %d command objects'
+                  %(len(seq), distinct or 'all', nbytes[0] / 1e6, nbytes[1] / 1e6, len(seq.table)))
+        finally:
+            os.remove(path)
+    sequence.SEQUENCE_CACHE_ENABLED = globs.SEQUENCE_CACHE_ENABLED
+
+
+def bench_parser(nlines=100000):
+    '''parse a synthetic sequence of mixed shell and builtin lines, no cache'''
+    sequence.SEQUENCE_CACHE_ENABLED = False
+    path = synthetic_mixed_sequence(nlines)
+    try:
+        reader = SequenceReader(path)
+        t_start = time.perf_counter()
+        reader.parse_lines()
+        elapsed = time.perf_counter() - t_start
+        print('parser: %d lines in %.3fs, %.1f us/line, %d builtins registered'
+              %(nlines, elapsed, elapsed * 1e6 / nlines, len(sequence.BuiltinCmd.registry)))
+
+        with open(path) as fp:
+            lines = [line.rstrip('\n') for line in fp]
+        t_start = time.perf_counter()
+        nbuiltins = sum(1 for line in lines if sequence.BuiltinCmd.discovery(line) is not None)
+        elapsed = time.perf_counter() - t_start
+        print('parser: builtin dispatch of %d lines in %.3fs, %d builtins' %(nlines, elapsed, nbuiltins))
+    finally:
+        os.remove(path)
+        sequence.SEQUENCE_CACHE_ENABLED = globs.SEQUENCE_CACHE_ENABLED
+
+
+def legacy_make_shellcmd_args_by_line(line):
+    '''the sentinel replace tokenizer, kept as the tokenizer baseline'''
+    escapes = {"\\;": chr(128), "\\,": chr(129), "\\ ": chr(130)}
+    for esc, c in escapes.items():
+        line = line.replace(esc, c)
+    items = [x.strip(' ') for x in line.split(';') if x]
+    cmd, items = (items[0], items[1:]) if items else ('', items)
+    for i, item in enumerate(items):
+        item = item.replace(chr(128), ";")
+        items[i] = [y.strip(' ') for y in item.split(',') if y]
+        for j, subitem in enumerate(items[i]):
+            items[i][j] = subitem.replace(chr(129), ",").replace(chr(130), " ")
+    return [cmd, ] + [tuple(x) for x in items]
+
+
+def legacy_make_bltincmd_args_by_line(line):
+    line = line.replace("\\ ", chr(130))
+    return [x.replace(chr(130), ' ') for x in line.split(' ') if x]
+
+
+def bench_tokenizer(nlines=100000, repeat=5):
+    '''tokenize sequence lines with and without escapes or quotes, legacy against current'''
+    shell_lines = {
+        'plain': ['ipmitool raw 0x30 0x%02x %d; ok, done; fail msg; 30' %(i % 7, i)
+                  for i in range(nlines)],
+        'escaped': ['echo a\\;b %d; ok\\, done, 0x%02x; fail\\ msg; 30' %(i, i % 7)
+                    for i in range(nlines)],
+        'quoted': ['echo "a;b %d" 0x%02x; ok, done; fail msg; 30' %(i, i % 7)
+                   for i in range(nlines)],
+        }
+    bltin_lines = {
+        'plain': ['SETPROMPT bench%d> now' %(i) for i in range(nlines)],
+        'escaped': ['SETPROMPT bench\\ %d> now' %(i) for i in range(nlines)],
+        }
+    pairs = (
+        ('shell', shell_lines, legacy_make_shellcmd_args_by_line, command.make_shellcmd_args_by_line),
+        ('builtin', bltin_lines, legacy_make_bltincmd_args_by_line, command.make_bltincmd_args_by_line),
+        )
+    for kind, lines, legacy, current in pairs:
+        for name, batch in lines.items():
+            elapsed = [None, None]
+            for i in range(repeat):     # best of repeat, taken in turns as load drifts
+                for j, func in enumerate((legacy, current)):
+                    t_start = time.perf_counter()
+                    for line in batch:
+                        func(line)
+                    t = time.perf_counter() - t_start
+                    elapsed[j] = t if elapsed[j] is None else min(elapsed[j], t)
+            print('tokenizer: %s %s, %d lines, legacy %.3fs, current %.3fs, x%.2f'
+                  %(kind, name, nlines, elapsed[0], elapsed[1], elapsed[0] / elapsed[1]))
+
+
+def bench_async_sessions(nsessions=200, loops=3):
+    '''run nsessions local shell sessions in this process with the asyncio
+    engine, memory and time per session'''
+    import asyncagent
+    path = synthetic_sequence(0)
+    with open(path, 'w') as fp:
+        fp.write('echo session $%s; session; 10\n' %(globs.TARGET_ENV))
+        fp.write('WAIT 1s\n')
+    try:
+        reader = sequence.get_parsed_seqreader(path)
+        def run():
+            engine = asyncagent.AsyncEngine()
+            for i in range(nsessions):
+                agent = asyncagent.AsyncAgent('bench#%d' %(i), env={globs.TARGET_ENV: str(i)})
+                engine.add_session(asyncagent.AsyncSession(agent, reader, loops))
+            t_start = time.perf_counter()
+            results = engine.run()
+            return results, time.perf_counter() - t_start
+        (results, elapsed), mem = measure_memory(run)
+    finally:
+        os.remove(path)
+    failed = sum(1 for r in results if isinstance(r, BaseException) or r.failure_loops)
+    print('async sessions: %d sessions x %d loops, %.2fs, %d failed, %.1f KiB per session'
+          %(nsessions, loops, elapsed, failed, mem / 1024.0 / nsessions))
+
+
+def _idle_worker(seconds):
+    time.sleep(seconds)    # a sequence waiting on its remote console
+
+
+def _pss_kib(pid):
+    '''proportional set size of a process, shared pages split among sharers'''
+    try:
+        with open('/proc/%d/smaps_rollup' %(pid)) as fp:
+            for line in fp:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def bench_worker_backends(nworkers=50, seconds=1.0):
+    '''start nworkers idle workers at once as processes and as threads,
+    start time, wall time and memory of the whole test'''
+    import pool
+    for backend, context in (('process', None), ('thread', pool.THREAD_CONTEXT)):
+        workers = pool.WorkerPool(nworkers, context=context)
+        pss_start = _pss_kib(os.getpid())
+        t_start = time.perf_counter()
+        runs = [workers.submit(_idle_worker, (seconds,)) for i in range(nworkers)]
+        t_started = time.perf_counter()
+        pss = _pss_kib(os.getpid()) - pss_start
+        if backend == 'process':
+            pss += sum(_pss_kib(run.process.pid) for run in runs)
+        workers.drain()
+        elapsed = time.perf_counter() - t_start
+        latency = sum(run.spawn_latency for run in runs) / nworkers
+        print('backends: %s, %d workers, start %.3fs (%.2f ms each), wall %.2fs, %.0f KiB per worker'
+              %(backend, nworkers, t_started - t_start, latency * 1e3, elapsed, pss / float(nworkers)))
+
+
+BENCHMARKS = {
+    'memory': bench_command_memory,
+    'parser': bench_parser,
+    'tokenizer': bench_tokenizer,
+    'sessions': bench_async_sessions,
+    'backends': bench_worker_backends,
+    }
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        t_start = time.perf_counter()
+        BENCHMARKS[name]()
+        print('[%s] %.2fs' %(name, time.perf_counter() - t_start))
@@ -1,15 +1,15 @@
-import os
+import time
 import re
-from multiprocessing import Process
+import sys
+from collections import namedtuple
 
 import utils
-import worker
-from worker import get_this_worker
+from stats import get_this_stats
 from globs import *
 from errors import *
 import uds
 from uds import MESSAGES as MSGS
-from sequence import get_this_seqfile, get_this_seqreader
+from matcher import resolve_pattern, ExpectMatcher, compile_probe_patterns
 
 
 __all__ = [
@@ -17,6 +17,7 @@ __all__ = [
     'make_bltincmd_args_by_line',
     'BuiltinCmd',
     'ShellCmd',
+    'ExecPlan',
     'CTRL_C',
     'RUN',
     'RUN_WAIT',
@@ -31,68 +32,102 @@ __all__ = [
     'PASSWD',
     ]
 
+# worker and sequence import this module, their state is looked up when a
+# command runs or is parsed, by then both are imported
+def get_this_worker():
+    import worker
+    return worker.get_this_worker()
+
+def get_this_seqreader():
+    import sequence
+    return sequence.get_this_seqreader()
+
+# the command item of a sequence line and the ';' ending it
+R_COMMAND_ITEM = re.compile(r'([^\\;]*(?:\\[;, ]?[^\\;]*)*)(;?)')
+# a subarg of the items after the command and the ';' or ',' ending it
+R_SUBARG = re.compile(r'([^\\;,]*(?:\\[;, ]?[^\\;,]*)*)([;,]?)')
+
+def _unescape(arg, text):
+    '''resolve the escapes of arg, which is text stripped of spaces, an
+    escaped space at the end of text is kept'''
+    if arg[-1] == '\\' and text[-1] == ' ':
+        arg += ' '
+    return arg.replace('\\;', ';').replace('\\,', ',').replace('\\ ', ' ')
+
 # to make args as [cmd, (argx1, argx2...), (argy1, argy2)...]
 # args are separated by ';'
 # subargs are separated by ','
+# '\;', '\,' and '\ ' escape the delimiters and space
 def make_shellcmd_args_by_line(line):
-    item_delimiter = ';'
-    subitem_delimiter = ','
-    escapes = {
-        "\\;": chr(127 + 1),    # semicolon, used to separate items
-        "\\,": chr(127 + 2),    # comma, used to separate subitems
-        "\\ ": chr(127 + 3),    # space, used to separate builtin command args
-        }
-    for esc, c in escapes.items():
-        line = line.replace(esc, c)
-
-    items = [x.strip(' ') for x in line.split(item_delimiter) if x]
-
-    if items:
-        cmd = items[0]
-        items = items[1:]
-    else:
-        cmd = ''
-
-    for i, item in enumerate(items):
-        item = item.replace(chr(128), ";")
-        items[i] = [y.strip(' ') for y in item.split(subitem_delimiter) if y]
-        for j, subitem in enumerate(items[i]):
-            subitem = subitem.replace(chr(129), ",")
-            subitem = subitem.replace(chr(130), " ")
-            items[i][j] = subitem
-
-    makeargs = [cmd, ] + [tuple(x) for x in items]
+    if '\\' not in line:  # nothing escaped, plain C level splits
+        items = [x.strip(' ') for x in line.split(';') if x]
+        cmd = items[0] if items else ''
+        return [cmd, ] + [tuple(y.strip(' ') for y in x.split(',') if y) for x in items[1:]]
+
+    # one scan of the line from left to right, empty items are dropped
+    pos, end = 0, len(line)
+    text = ''
+    while not text and pos < end:
+        m = R_COMMAND_ITEM.match(line, pos)
+        text = m.group(1)
+        pos = m.end()
+    cmd = text.strip(' ')
+    makeargs = [_unescape(cmd, text) if '\\' in cmd else cmd, ]
+
+    subargs = []
+    first = True        # the subarg is the first of its item
+    opened = False      # the item isn't empty
+    for text, delimiter in R_SUBARG.findall(line, pos):
+        if text:
+            opened = True
+            arg = text.strip(' ')
+            if arg:
+                subargs.append(_unescape(arg, text) if '\\' in arg else arg)
+            # as if the item was stripped before it was split, a subarg of
+            # spaces only is dropped at either end of the item
+            elif delimiter == ',' and not first:
+                subargs.append(arg)
+        if delimiter == ',':
+            opened = True
+            first = False
+        else:           # ';' or the end of line
+            if opened:
+                makeargs.append(tuple(subargs))
+                subargs = []
+                opened = False
+            first = True
 
     return makeargs
 
 # to make args as [cmd, arg1, arg2...]
-# args are separated by ' '
+# args are separated by ' ', '\ ' escapes space
 def make_bltincmd_args_by_line(line):
-    delimiter = ' '
-    escapes = {
-        "\\ ": chr(127 + 3),    # space, used to separate builtin command args
-        }
-    for esc, c in escapes.items():
-        line = line.replace(esc, c)
+    if '\\ ' not in line:
+        return [x for x in line.split(' ') if x]
 
-    makeargs = [x for x in line.split(delimiter) if x]
+    # an escaped space joins the last word before it and the first after it
+    parts = line.split('\\ ')
+    makeargs = parts[0].split(' ')
+    for part in parts[1:]:
+        words = part.split(' ')
+        makeargs[-1] += ' ' + words[0]
+        makeargs += words[1:]
 
-    for i, arg in enumerate(makeargs):
-        makeargs[i] = arg.replace(chr(130), ' ')    # swap back to space
-
-    return makeargs
+    return [x for x in makeargs if x]
 
 
 class Cmd(object):
-    """Base command class"""
+    """Base command class, commands are slotted and hold no per-run output,
+    run output is returned to the caller of exec only."""
+    __slots__ = ('command', 'terminator', 'probe_count', 'args')
+
     def __init__(self, **kw):
         # each command must contain following args
         self.command = None
         self.terminator = None  # string to probe the termination of execution
         self.probe_count = 0    # how many times we need to probe
-        self.output = ''        # command output, for later populating
 
-        for k, v in kw,items():
+        for k, v in kw.items():
             if k and v:
                 setattr(self, k, v)
 
@@ -106,13 +141,13 @@ class Cmd(object):
         setattr(self, key, value)
 
     def __str__(self):
-        if isinstance(self, BuiltinCmd)
+        if isinstance(self, BuiltinCmd):
             return self.token + ': ' + self.description
-        if isinstance(self, ShellCmd)
+        if isinstance(self, ShellCmd):
             return self.command
 
     def __repr__(self):
-        if isinstance(self, BuiltinCmd)
+        if isinstance(self, BuiltinCmd):
             rpr1 = str(self)
             rpr2 = 'usage: ' + self.usage
             cmd_rpr = utils.concat_text_lines(rpr1, rpr2)
@@ -122,18 +157,31 @@ class Cmd(object):
         arg_rpr = 'args: ' + repr(self.args)
         dict_rpr = 'dict: ' + repr(self.dict)
 
-        return utils.concat_text_lines(cmd_rpr, arg_rpr, dict_rpr, self.output)
+        return utils.concat_text_lines(cmd_rpr, arg_rpr, dict_rpr)
 
     @property
     def dict(self):
-        if self.__dict__:
-            return self.__dict__
+        slots = [s for cls in type(self).__mro__ for s in getattr(cls, '__slots__', ())]
+        attrs = {s: getattr(self, s) for s in slots if hasattr(self, s)}
+        if attrs:
+            return attrs
         else:
             return 'NUL'        # return this for concatenating strings
 
 
+# immutable execution plan of a shell command, compiled once at parse time
+#   command:  command string
+#   data:     encoded command bytes to send to tty
+#   expects:  pre-resolved expect Patterns, probed in order
+#   probe:    MultiPattern of shell error messages and the command's escapes
+#   timeout:  effective timeout in seconds, None for no timeout
+ExecPlan = namedtuple('ExecPlan', ['command', 'data', 'expects', 'probe', 'timeout'])
+
+
 class ShellCmd(Cmd):
     """Normal shell command class"""
+    __slots__ = ('timeout', 'expects', 'escapes', 'enterchar', 'plan')
+
     def __init__(self, args):
         super().__init__()
 
@@ -146,6 +194,9 @@ class ShellCmd(Cmd):
         if len(args) > 4:
             raise SequenceError("Normal Command Syntax Error, Args: %r" %(args))
 
+        # generated sequences repeat the same expects and escapes on many
+        # lines, interned subitems are stored once however many lines use them
+        args = [args[0]] + [tuple(sys.intern(x) for x in arg) for arg in args[1:]]
         self.args = args
         # get timeout arg firstly
         self.timeout = DEFAULT_SHELLCMD_TIMEOUT
@@ -163,6 +214,18 @@ class ShellCmd(Cmd):
         self.escapes = f(args, 2)
 
         self.enterchar = None
+        self.plan = self.compile()
+
+    def compile(self):
+        '''Compile this command into its execution plan, so running it
+        doesn't redo any pattern classification or encoding'''
+        tupled = lambda x: tuple(x) if isinstance(x, (tuple, list)) else ((x,) if x else ())
+        expects = tuple(resolve_pattern(p, ExpectMatcher.flags) for p in tupled(self.expects) if p)
+        escapes = tupled(self.escapes)
+        probe = compile_probe_patterns(escapes or None)
+        timeout = self.timeout if self.timeout and self.timeout > 0 else None
+
+        return ExecPlan(self.command, utils.BYTES(self.command), expects, probe, timeout)
 
 #
 #
@@ -172,25 +235,34 @@ class ShellCmd(Cmd):
 # because at this moment, the module `worker` contains the latest sequence.
 class BuiltinCmd(Cmd):
     """Builtin command class"""
+    __slots__ = ('timeout',)
+    is_seq_cmd = True   # if this command is sequence command, if not, don't append it to the sequence
+    registry = {}       # first token -> builtin command class, filled as subclasses are defined
+    tokens = ()         # tokens of a builtin command, by default its `token`
+
+    def __init_subclass__(cls, **kw):
+        super().__init_subclass__(**kw)
+        for token in cls.tokens or (cls.token,):
+            if token in BuiltinCmd.registry:
+                raise SequenceError('Duplicated builtin command token: %r' %(token))
+            BuiltinCmd.registry[token] = cls
+
     def __init__(self, args, **kw):
-        super().__init__(self, **kw)
-        self.is_seq_cmd = True  # if this command is sequence command, if not, don't append it to the sequence
+        super().__init__(**kw)
         self.timeout = DEFAULT_BLTINCMD_TIMEOUT
         self.args = args
 
     @classmethod
     def discovery(cls, line):   # line is a concatenated raw line
-        inst = None
-        args = make_bltincmd_args_by_line(line)
-
-        if args:  # at least contain 1 arg
-            subclasses = cls.__subclasses__()
-
-            for subcls in subclasses:
-                inst = subcls.discovery(args)
-                if inst: break
+        # the first token picks the builtin class, lines of any other token
+        # fall back to shell commands after this single dict lookup
+        token = line.lstrip(' ').split(' ', 1)[0]
+        subcls = cls.registry.get(token)
+        if subcls is None:
+            return None
 
-        return inst
+        args = make_bltincmd_args_by_line(line)
+        return subcls.discovery(args)
 
     def exec(self):
         print("Warning: command `%s` doesn't implement exec method, bypassed.")
@@ -201,6 +273,7 @@ CTRL-C
 """
 class CTRL_C(BuiltinCmd):
     """CTRL-C definition class"""
+    __slots__ = ()
     token = 'CTRL-C'
     usage = 'CTRL-C'
     argc = (1,)
@@ -221,7 +294,7 @@ class CTRL_C(BuiltinCmd):
 
     @classmethod
     def discovery(cls, args):
-        if cls.syntax_parse(args):
+        if cls.syntax_check(args):
             return cls(args)
 
         return None
@@ -234,8 +307,9 @@ class CTRL_C(BuiltinCmd):
 """
 RUN
 """
-class RUN(BuiltCmd):
+class RUN(BuiltinCmd):
     """Spawn a new sequence worker and dont wait"""
+    __slots__ = ('seq_file', 'seq_loops')
     token = 'RUN'
     usage = 'RUN [seq_file] [loops]'
     argc = (2, 3,)
@@ -270,21 +344,37 @@ class RUN(BuiltCmd):
 
         return None
 
-    def exec(self):
-        new_worker = Process(target = worker.run_sequence_worker,
-                             args = (self.seq_file,
-                                     self.seq_loops))
-        new_worker.start()  # start the sequence worker
-        # notify server that new worker has started
+    def worker_args(self, this_worker):
+        '''new worker runs in the shard and on the target of this worker'''
+        import worker
+        shard = (this_worker.shard, 1) if this_worker.shard is not None else None
+        stats = get_this_stats()
+        stats = (stats, stats.alloc()) if stats is not None else None
+        return (self.seq_file, self.seq_loops, worker.WIN_DISPLAY_EN, shard, this_worker.target, stats)
+
+    def notify_start(self, run):
+        '''notify server that new worker has started'''
+        shard = run.args[3]
         msg = {
             'MSG': MSGS.worker_run_start.value,
-            'NAME': self.seq_file.split(os.sep)[-1].split('.')[0],
+            'NAME': utils.get_sequence_name(self.seq_file, shard[0] if shard else None),
             'LOOPS': self.seq_loops,
+            'SPAWN': run.spawn_latency,
+            'ID': run.args[5][1] if run.args[5] else None,
             }
+        if shard:   # results are merged with the runs of the other shards
+            msg['SEQUENCE'] = utils.get_sequence_name(self.seq_file)
         this_uds = uds.get_this_uds()
         this_uds.send_server_msg(msg)
+
+    def exec(self):
+        from worker import run_sequence_worker
         this_worker = get_this_worker()
-        this_worker.spawned_workers.append(new_worker)
+        # start the sequence worker, or queue it until the pool has a free slot
+        run = this_worker.pool.submit(run_sequence_worker,
+                                      self.worker_args(this_worker),
+                                      on_start=self.notify_start)
+        this_worker.spawned_workers.append(run)
         return True
 
 """
@@ -292,6 +382,7 @@ RUN_WAIT
 """
 class RUN_WAIT(BuiltinCmd):
     """Spawn a new sequence worker and wait for it to end"""
+    __slots__ = ('seq_file', 'seq_loops')
     token = 'RUN_WAIT'
     usage = 'RUN_WAIT [seq_file] [loops]'
     argc = (2, 3,)
@@ -326,22 +417,16 @@ class RUN_WAIT(BuiltinCmd):
 
         return None
 
+    worker_args = RUN.worker_args
+    notify_start = RUN.notify_start
+
     def exec(self):
-        new_worker = Process(target = worker.run_sequence_worker,
-                             args = (self.seq_file,
-                                     self.seq_loops))
-        new_worker.start()  # start the sequence worker
-        # notify server that new worker has started
-        msg = {
-            'MSG': MSGS.worker_run_start.value,
-            'NAME': self.seq_file.split(os.sep)[-1].split('.')[0],
-            'LOOPS': self.seq_loops,
-            }
-        this_uds = worker.get_this_uds()
-        this_uds.send_server_msg(msg)
+        from worker import run_sequence_worker
         this_worker = get_this_worker()
-        this_worker.spawned_workers.append(new_worker)
-        new_worker.join()  # wait for the new process to complete
+        # the new worker runs in this worker's pool slot while we wait for it
+        this_worker.pool.run_wait(run_sequence_worker,
+                                  self.worker_args(this_worker),
+                                  on_start=self.notify_start)
         return True
 
 """
@@ -349,6 +434,7 @@ CLOSE
 """
 class CLOSE(BuiltinCmd):
     """Close THIS pty"""
+    __slots__ = ()
     token = 'CLOSE'
     usage = 'CLOSE'
     argc = (1,)
@@ -383,6 +469,7 @@ ENTER
 """
 class ENTER(BuiltinCmd):
     """Press an enter button"""
+    __slots__ = ()
     token = 'ENTER'
     usage = 'ENTER'
     argc = (1,)
@@ -417,6 +504,7 @@ WAIT
 """
 class WAIT(BuiltinCmd):
     """Wait for some time"""
+    __slots__ = ('time', 'waitsec')
     token = 'WAIT'
     usage = 'WAIT [time]'
     argc = (2,)
@@ -452,6 +540,7 @@ PULSE
 """
 class PULSE(BuiltinCmd):
     """Send the pulse shell command in case that remote connection drops"""
+    __slots__ = ()
     token = 'PULSE'
     usage = 'PULSE'
     argc = (1,)
@@ -488,6 +577,7 @@ SETPROMPT
 """
 class SETPROMPT(BuiltinCmd):
     """Set THIS agent's pty prompt"""
+    __slots__ = ('prompt', 'promptstr')
     token = 'SETPROMPT'
     usage = 'SETPROMPT [promptstr]'
     argc = (2,)
@@ -524,6 +614,7 @@ FIND
 """
 class FIND(BuiltinCmd):
     """Find a certain file under a set of directories"""
+    __slots__ = ('fname', 'paths')
     token = 'FIND'
     usage = 'FIND [filename] [list of directories, separated by comma]'
     argc = (3,)
@@ -571,22 +662,24 @@ SUBSEQUENCE
 """
 class SUBSEQUENCE(BuiltinCmd):
     """Define a subsequence by specifying a symbol name"""
-    token = r'^SUBSEQUENCE$|^ENDSUBSEQUENCE$'
+    __slots__ = ()
+    is_seq_cmd = False  # we won't append subsequence command to the command sequence
+    token = 'SUBSEQUENCE'
+    tokens = ('SUBSEQUENCE', 'ENDSUBSEQUENCE',)
     usage = 'SUBSEQUENCE [symbol] / ENDSUBSEQUENCE'
     argc = (1, 2,)
     description = 'define a subsequnce of the completed sequence as a symbol.'
 
     def __init__(self, args, **kw):
         super().__init__(args, **kw)
-        self.is_seq_cmd = False     # we won't append subsequence command to the command sequence
 
     def __str__(self):
-        '''since we use a regex to match this command, we need to define its own __str__'''
+        '''since this command owns two tokens, we need to define its own __str__'''
         return self.args[0]
 
     @classmethod
     def syntax_check(cls, args):
-        if re.search(cls.token, args[0]):
+        if args[0] in cls.tokens:
             if (args[0] == 'SUBSEQUENCE' and len(args) == 2) or \
                     (args[0] == 'ENDSUBSEQUENCE' and len(args) == 1):
                 return True
@@ -601,19 +694,14 @@ class SUBSEQUENCE(BuiltinCmd):
             this_seqreader = get_this_seqreader()
             if args[0] == 'SUBSEQUENCE':
                 if this_seqreader.subsequence_probe is not None:
-                    raise BuiltinCmdError('Do not use SUBSEQUENCE command recursively, usage: %s', %(cls.usage))
+                    raise BuiltinCmdError('Do not use SUBSEQUENCE command recursively, usage: %s' %(cls.usage))
                 else:
-                    symbol = args[1]
-                    this_seqreader.subsequence_probe = (symbol, this_seqreader.cmd_counter)
+                    this_seqreader.begin_subsequence(args[1])
             else:
                 if this_seqreader.subsequence_probe is None:
-                    raise BuiltinCmdError('No previous pair SUBSEQUENCE command found, usage: %s', %(cls.usage))
+                    raise BuiltinCmdError('No previous pair SUBSEQUENCE command found, usage: %s' %(cls.usage))
                 else:
-                    symbol = this_seqreader.subsequence_probe[0]
-                    start = this_seqreader.subsequence_probe[1]
-                    subsequence = this_seqreader.sequence[start:]
-                    this_seqreader.subsequences.update({symbol : subsequence})
-                    this_seqreader.subsequence_probe = None
+                    this_seqreader.end_subsequence()
 
             return cls(args)    # return to caller, telling it to take this command as a builtin command
 
@@ -624,6 +712,7 @@ LOOP
 """
 class LOOP(BuiltinCmd):
     """Loop a subsequence defined previously by user"""
+    __slots__ = ('symbol', 'loops')
     token = 'LOOP'
     usage = 'LOOP [subsequence symbol] [loops]'
     argc = (3,)
@@ -647,7 +736,7 @@ class LOOP(BuiltinCmd):
             symbol = args[1]
             loops = int(args[2])
             this_seqreader = get_this_seqreader()
-            if symbol not in this_seqreader.subsequences:
+            if not this_seqreader.has_subsequence(symbol):
                 raise BuiltinCmdError('Invalid subsequence symbol: %s' %(symbol))
             return cls(args, symbol=symbol, loops=loops)
 
@@ -656,7 +745,7 @@ class LOOP(BuiltinCmd):
     def exec(self):
         this_worker = get_this_worker()
         sequence = this_worker.subsequences[self.symbol]
-        this_worker.run_sequence(sequence=sequence, loops=self.loops)
+        this_worker.push_frame(sequence, self.loops, self.symbol)  # run by the worker's loop interpreter
         return True
 
 """
@@ -664,6 +753,7 @@ PASSWD
 """
 class PASSWD(BuiltinCmd):
     """Indicate that this command arg is to send a password string, which should be invisble"""
+    __slots__ = ('passwd',)
     token = 'PASSWD'
     usage = 'PASSWD [password]'
     argc = (2,)
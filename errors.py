@@ -19,7 +19,7 @@ class AgentBaseError(Exception):
         self.output = kw.get('output')
 
     def __str__(self):
-        s = '%s: %s\n' + %(self.__class__.__name__, self.args[0] if self.args else 'NULL')
+        s = '%s: %s\n' %(self.__class__.__name__, self.args[0] if self.args else 'NULL')
         if self.prompt:
             s = s + 'SHELL PROMPT:\n%s\n\n' %(self.prompt)
         if self.output:
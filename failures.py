@@ -0,0 +1,139 @@
+import os
+import re
+import json
+import sqlite3
+import tempfile
+from collections import deque
+
+import utils
+from globs import *
+
+
+R_NUMBER = re.compile(r'0[xX][0-9a-fA-F]+|\d+')    # hex or decimal numbers, masked as #
+SIGNATURE_TEXT_MAX = 200        # characters of a masked error or output kept in a signature
+
+
+class FailureHistory(object):
+    """Failing loops of all workers, with their failure messages.
+
+    The most recent failures are kept in memory, at most window of them.
+    Older ones are spilled in batches to an sqlite store indexed by worker
+    and loop, created on the first spill. Master memory stays bounded on
+    long flaky soaks, and every failing loop can still be listed."""
+
+    def __init__(self, directory, prefix, window=FAILURE_WINDOW):
+        self.directory = directory  # where the store is created
+        self.prefix = prefix        # store file name prefix
+        self.path = None            # store file, spilled failures only
+        self.window = max(window, 1)
+        self.recent = deque()       # (worker id, loop, messages), oldest first
+        self.db = None
+        self.spilled = 0            # failures in the store
+
+    def open_store(self):
+        # a new file, tests started in the same minute keep their own stores
+        fd, self.path = tempfile.mkstemp(suffix='.db', prefix=self.prefix, dir=self.directory)
+        os.close(fd)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('CREATE TABLE failures (worker TEXT, loop INTEGER, messages TEXT)')
+        self.db.execute('CREATE INDEX failures_worker_loop ON failures (worker, loop)')
+
+    def spill(self):
+        '''Move the older half of the window to the store'''
+        if self.db is None:
+            self.open_store()
+        n = max(len(self.recent) - self.window // 2, 1)
+        rows = []
+        for i in range(n):
+            worker_id, loop, messages = self.recent.popleft()
+            rows.append((str(worker_id), loop, json.dumps(messages)))
+        with self.db:
+            self.db.executemany('INSERT INTO failures VALUES (?, ?, ?)', rows)
+        self.spilled += n
+
+    def add(self, worker_id, loop, messages):
+        self.recent.append((worker_id, loop, messages))
+        if len(self.recent) > self.window:
+            self.spill()
+
+    def loops(self, worker_id):
+        '''Sorted failing loops of the worker'''
+        loops = [loop for wid, loop, messages in self.recent if wid == worker_id]
+        if self.db is not None:
+            loops.extend(row[0] for row in self.db.execute(
+                'SELECT loop FROM failures WHERE worker = ? ORDER BY loop', (str(worker_id),)))
+        loops.sort()
+        return loops
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def __len__(self):
+        return self.spilled + len(self.recent)
+
+
+def mask_text(text):
+    '''text with its leading date stripped and numbers masked, so the same
+    failure in different loops gives the same text'''
+    text = utils.strip_text_date(text).strip()
+    return R_NUMBER.sub('#', text)[:SIGNATURE_TEXT_MAX]
+
+
+def failure_signature(failure):
+    '''Signature of a failure message made by SequenceWorker.format_errinfo:
+    (error class, masked error, command, session, masked output)'''
+    return (failure['CLASS'], mask_text(failure['DESCRIPTION']),
+            failure['COMMAND'], failure['SESSION'], mask_text(failure['OUTPUT']))
+
+
+class FailureSignature(object):
+    """A distinct failure, with how many times and in which loops it occurred"""
+    __slots__ = ('id', 'key', 'count', 'first', 'last', 'failure')
+
+    def __init__(self, signature_id, key, failure):
+        self.id = signature_id
+        self.key = key
+        self.count = 0
+        self.first = None       # (worker name, loop) of the first occurrence
+        self.last = None        # (worker name, loop) of the last occurrence
+        self.failure = failure  # failure message of the first occurrence
+
+    def __str__(self):
+        errclass, errdesc, command, session, output = self.key
+        text = '#%d x %d, first loop %r of %s, last loop %r of %s\n' %(self.id, self.count,
+                                                                      self.first[1], self.first[0],
+                                                                      self.last[1], self.last[0])
+        text += '    %s\n    Command: %s\n    Session: %s\n' %(errdesc, command or 'ENTER', session)
+        if output:
+            text += '    Output: %s\n' %(output)
+        return text
+
+
+class FailureSignatures(object):
+    """Failures of the test aggregated by signature, in order of first occurrence"""
+
+    def __init__(self):
+        self.signatures = {}    # signature key -> FailureSignature
+
+    def add(self, failure, name, loop):
+        '''Count a failure, return its signature and if it's the first occurrence'''
+        key = failure_signature(failure)
+        signature = self.signatures.get(key)
+        new = signature is None
+        if new:
+            signature = FailureSignature(len(self.signatures) + 1, key, failure)
+            signature.first = (name, loop)
+            self.signatures[key] = signature
+        signature.count += 1
+        signature.last = (name, loop)
+
+        return signature, new
+
+    def report(self):
+        '''Every distinct failure once, with counts and first and last loops'''
+        return ''.join(str(signature) for signature in self.signatures.values())
+
+    def __len__(self):
+        return len(self.signatures)
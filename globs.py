@@ -69,10 +69,25 @@ LOGGING_ENABLED = True                      # if log is enabled
 STOP_ON_FAILURE = False                     # if test stops when failure is detected
 LOOP_ITERATIONS = 1                         # test loop iterations
 MAIN_SEQUENCE_FILE = ''                     # entry sequence file, the sequence to start all tests
+SEQUENCE_CACHE_ENABLED = True               # if parsed sequences are cached on disk
+# parsed sequence cache directory, private to the user as cached sequences are unpickled
+SEQUENCE_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'autosequence')
+SEQUENCE_STREAMING = False                  # if sequences are parsed on demand while running
+STREAM_LOOKAHEAD = 64                       # raw lines read ahead of the running command when streaming
+WORKER_POOL_SIZE = 5                        # maximum sequence workers running at once
+LOOP_SHARDS = 1                             # workers the main sequence's test loops are split across
+LOOP_TARGETS = ()                           # targets of the shards, one per shard
+TARGET_ENV = 'AUTOSEQ_TARGET'               # environment variable holding a worker's target
+FAILURE_WINDOW = 1000                       # failed loops the master keeps in memory, older ones go to disk
+ERROR_OUTPUT_MAX = 200                      # characters of the last output line kept in a failure info
+MAX_STATS_SLOTS = 1024                      # workers counting their loops in shared memory, later ones send messages
+WORKER_BACKEND = 'process'                  # sequence workers run as 'process'es or 'thread's
+ASYNC_SESSIONS = 0                          # sessions run by the asyncio engine in one process, 0 to run workers
 
 #print_window_message = True
 DEFAULT_LOCAL_PS1 = '>>>'                   # local shell prompt string
-TEST_RECOVER_RETRY = 3                      # test recover retry count
+LOCAL_SHELL = ('/bin/sh',)                  # local shell an agent starts in to run shell commands
+TEST_RECOVERY_RETRY = 3                     # test recover retry count
 SESSION_PROMPT_RETRY = 4                    # session prompt set/get retry count
 SESSION_PROMPT_RETRY_TIMEOUT = 5            # session prompt set/get retry timeout
 
@@ -0,0 +1,261 @@
+import re
+import functools
+
+import utils
+from utils import BYTES
+from globs import R_PROMPT_INPUT_REDY, CMD_ERR_MSGS
+
+
+REGEX_LOOKBEHIND = 256      # bytes rescanned before the resume offset for regexes
+PROMPT_TAIL_WINDOW = 512    # bytes at the end of the last line searched for a prompt
+
+
+def line_view(ring, begin, end):
+    '''Return (view, pos) for searching ring bytes [begin, end) with the
+    view's regex.search(view, pos): the view starts one byte before begin,
+    so under re.M ^ matches at begin only if a newline precedes it'''
+    head = max(begin - 1, ring.start)
+    return ring.view(head, end), begin - head
+
+
+class Pattern(object):
+    """One expect/escape pattern compiled for searching a RingBuffer.
+
+    Like utils.magic_search, a pattern is probed as a literal string first
+    and as a regex second, regex is utils.LITERAL if the pattern isn't a
+    valid regex."""
+    __slots__ = ('text', 'literal', 'regex', 'lookbehind')
+
+    def __init__(self, text, flags=re.M):
+        self.text = text
+        self.literal = BYTES(text)
+        self.regex = utils.compile_pattern(self.literal, flags)
+        # how far before the resume offset a match may start and still be new
+        self.lookbehind = REGEX_LOOKBEHIND if self.regex is not utils.LITERAL else len(self.literal) - 1
+
+    def search(self, ring, begin, end):
+        '''Search ring stream bytes [begin, end), return absolute (start, end)
+        of the match, None if not found'''
+        pos = ring.find(self.literal, begin, end)
+        if pos >= 0:
+            return pos, pos + len(self.literal)
+        if self.regex is not utils.LITERAL:
+            begin = max(begin, ring.start)
+            view, pos = line_view(ring, begin, end)
+            m = self.regex.search(view, pos)
+            if m is not None:
+                return begin - pos + m.start(), begin - pos + m.end()
+        return None
+
+
+@functools.lru_cache(maxsize=utils.PATTERN_CACHE_SIZE)
+def resolve_pattern(text, flags=re.M):
+    '''Shared Pattern of text, identical patterns of many commands are one object'''
+    return Pattern(text, flags)
+
+
+class StreamMatcher(object):
+    """Incremental matcher base, scans only data arrived since the last feed.
+
+    Each pattern keeps a resume offset into the stream, a feed rescans at
+    most the pattern's lookbehind before it, so probing a command costs
+    O(new data) rather than O(whole output) no matter how often it's fed."""
+
+    flags = re.M
+
+    def __init__(self, patterns, begin=0):
+        if not isinstance(patterns, (tuple, list)):
+            patterns = (patterns,)
+        # patterns may come pre-resolved from a command's execution plan
+        self.patterns = [p if isinstance(p, Pattern) else Pattern(p, self.flags)
+                         for p in patterns if p]
+        self.begin = begin      # stream offset the matched output starts from
+
+    def _window(self, pattern, resume, floor):
+        return max(resume - pattern.lookbehind, floor)
+
+
+class ExpectMatcher(StreamMatcher):
+    """Match expect items in order, each one after the end of the previous."""
+
+    def __init__(self, patterns, begin=0):
+        super().__init__(patterns, begin)
+        self.index = 0          # index of the pattern we are probing
+        self.floor = begin      # end offset of the previous pattern's match
+        self.resume = begin     # offset up to which the current pattern was scanned
+
+    @property
+    def done(self):
+        return self.index >= len(self.patterns)
+
+    def feed(self, ring):
+        '''Scan new ring data, return True once all patterns are found'''
+        end = ring.tell()
+        while not self.done:
+            pattern = self.patterns[self.index]
+            span = pattern.search(ring, self._window(pattern, self.resume, self.floor), end)
+            if span is None:
+                self.resume = end
+                break
+            self.index += 1
+            self.floor = self.resume = span[1]
+
+        return self.done
+
+
+# pattern id kinds of the probe patterns
+PROBE_PROMPT = 'prompt'
+PROBE_ERROR = 'error'
+PROBE_ESCAPE = 'escape'
+
+# regexes that can't join a combined alternation, their group numbers would shift
+BACKREFERENCE = re.compile(rb'\\[1-9]|\(\?P=')
+
+
+class MultiPattern(object):
+    """Patterns combined into one regex, so a single pass over the data
+    reports which pattern ids hit.
+
+    Every pattern becomes a named alternative inside a lookahead, tried at
+    each position by the C regex engine. A literal is matched exactly and
+    case sensitively, a valid regex case insensitively, same as
+    utils.magic_search. Regexes using backreferences or inline global flags
+    are searched on their own. Where two patterns match at the same offset
+    only the first one is reported there."""
+
+    flags = re.M | re.I
+
+    def __init__(self, patterns):
+        self.ids = {}           # group name -> pattern id
+        self.texts = {}         # pattern id -> pattern text
+        self.singles = []       # [(pattern id, Pattern)] searched on their own
+        alternatives = []
+
+        for i, (pid, text) in enumerate(patterns):
+            if not text: continue
+            self.texts[pid] = text
+            literal = BYTES(text)
+            regex = utils.compile_pattern(literal, self.flags)
+            exact = b'(?-i:' + re.escape(literal) + b')'
+            if regex is utils.LITERAL:
+                source = exact
+            else:
+                source = exact + b'|(?:' + literal + b')'
+            name = '_mp%d' %(i)
+            alternative = b'(?P<' + BYTES(name) + b'>' + source + b')'
+            if BACKREFERENCE.search(literal) or \
+                    utils.compile_pattern(b'(?=' + alternative + b')', self.flags) is utils.LITERAL:
+                self.singles.append((pid, Pattern(text, self.flags)))
+                continue
+            self.ids[name] = pid
+            alternatives.append(alternative)
+
+        if alternatives:
+            self.regex = re.compile(b'(?=' + b'|'.join(alternatives) + b')', self.flags)
+        else:
+            self.regex = None
+        self.lookbehind = REGEX_LOOKBEHIND
+
+
+@functools.lru_cache(maxsize=utils.PATTERN_CACHE_SIZE)
+def compile_prompt_patterns(prompt=None):
+    '''Build the shell prompt patterns once, plus the agent's own prompt'''
+    patterns = [((PROBE_PROMPT, i), p) for i, p in enumerate(R_PROMPT_INPUT_REDY)]
+    if prompt:
+        patterns.append(((PROBE_PROMPT, len(patterns)), re.escape(prompt.rstrip()) + r' ?$'))
+
+    return MultiPattern(patterns)
+
+
+@functools.lru_cache(maxsize=utils.PATTERN_CACHE_SIZE)
+def compile_probe_patterns(escapes=None):
+    '''Build the probe patterns of a command once: shell error messages
+    and the command's escapes, ids are (kind, index)'''
+    patterns = [((PROBE_ERROR, i), p) for i, p in enumerate(CMD_ERR_MSGS)]
+    if escapes:
+        if not isinstance(escapes, (tuple, list)):
+            escapes = (escapes,)
+        patterns += [((PROBE_ESCAPE, i), p) for i, p in enumerate(escapes)]
+
+    return MultiPattern(patterns)
+
+
+class MultiMatcher(object):
+    """Incremental single pass matcher of a MultiPattern over a RingBuffer."""
+
+    def __init__(self, multipattern, begin=0):
+        self.multi = multipattern
+        self.begin = begin      # stream offset the matched output starts from
+        self.resume = begin     # offset up to which the stream was scanned
+        self.hits = {}          # pattern id -> absolute (start, end) of its latest match
+
+    def feed(self, ring):
+        '''Scan new ring data, return the ids hit by this feed'''
+        end = ring.tell()
+        begin = max(self.resume - self.multi.lookbehind, self.begin, ring.start)
+        newhits = set()
+
+        if self.multi.regex is not None:
+            ids = self.multi.ids
+            view, pos = line_view(ring, begin, end)
+            head = begin - pos
+            for m in self.multi.regex.finditer(view, pos):
+                name = m.lastgroup
+                self.hits[ids[name]] = (head + m.start(name), head + m.end(name))
+                newhits.add(ids[name])
+
+        for pid, pattern in self.multi.singles:
+            span = pattern.search(ring, begin, end)
+            if span is not None:
+                self.hits[pid] = span
+                newhits.add(pid)
+
+        self.resume = end
+        return newhits
+
+    def hit(self, kind):
+        '''Return the text of a hit pattern of kind, None if nothing hit'''
+        for pid in self.hits:
+            if pid[0] == kind:
+                return self.multi.texts[pid]
+        return None
+
+
+class PromptMatcher(object):
+    """Detect a shell prompt at the end of a RingBuffer stream.
+
+    Prompt patterns are end anchored, so only the tail of the last line can
+    match. The offset of the last newline is kept up to date by scanning new
+    data only, and the prompt search is bounded to PROMPT_TAIL_WINDOW bytes,
+    so detecting a finished command costs the same for 10 bytes of output
+    as for 10 MB."""
+
+    def __init__(self, multipattern, begin=0):
+        self.multi = multipattern
+        self.begin = begin          # stream offset the output starts from
+        self.resume = begin         # offset up to which newlines were indexed
+        self.last_newline = begin - 1
+
+    def feed(self, ring):
+        '''Index the last newline in new ring data'''
+        end = ring.tell()
+        nl = ring.rfind(b'\n', max(self.resume, ring.start), end)
+        if nl >= 0:
+            self.last_newline = nl
+        self.resume = end
+
+    def prompted(self, ring):
+        '''Return the prompt pattern text if the stream ends with a prompt'''
+        self.feed(ring)
+        end = ring.tell()
+        begin = max(self.last_newline + 1, end - PROMPT_TAIL_WINDOW, ring.start)
+        if self.multi.regex is not None:
+            tail = ring.view(begin, end)
+            for m in self.multi.regex.finditer(tail):
+                if m.end(m.lastgroup) == len(tail):
+                    return self.multi.texts[self.multi.ids[m.lastgroup]]
+        for pid, pattern in self.multi.singles:
+            span = pattern.search(ring, begin, end)
+            if span is not None and span[1] == end:
+                return self.multi.texts[pid]
+        return None
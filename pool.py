@@ -0,0 +1,197 @@
+import time
+import threading
+import contextvars
+import multiprocessing
+from collections import deque
+from multiprocessing import dummy
+
+from globs import *
+from spawnserver import SPAWN_METHODS, start_spawn_server, spawn_target, load_spawn_target
+
+
+POOL_POLL_INTERVAL = 0.2        # seconds between checks of pending runs while waiting
+
+
+class PendingRun(object):
+    """A sequence run waiting for a free worker slot"""
+    __slots__ = ('target', 'args', 'on_start', 'process', 'spawn_latency', 'held')
+
+    def __init__(self, target, args, on_start=None):
+        self.target = target
+        self.args = args
+        self.on_start = on_start    # called with the run once its process is started
+        self.process = None
+        self.spawn_latency = None   # seconds to get the worker process started
+        self.held = None            # shared flag set while the worker holds a slot
+
+    def kill(self):
+        if self.process is not None:
+            self.process.kill()
+
+
+class WorkerThread(threading.Thread):
+    """Thread running a sequence worker, in place of a process. The thread
+    runs in a copy of the starter's context, as a forked process inherits
+    the starter's globals. Threads can't be killed, kill() asks the worker
+    to stop once its running command is done."""
+
+    def __init__(self, target=None, args=()):
+        super().__init__(target=target, args=args, daemon=True)
+        self.context = contextvars.copy_context()
+        self.killed = threading.Event()
+
+    def run(self):
+        self.context.run(super().run)
+
+    def kill(self):
+        self.killed.set()
+
+
+class ThreadContext(object):
+    """multiprocessing context of the thread backend, workers are threads
+    of the master process"""
+    threads = True
+    Process = WorkerThread
+    BoundedSemaphore = staticmethod(threading.BoundedSemaphore)
+    Lock = staticmethod(threading.Lock)
+    Value = staticmethod(dummy.Value)
+
+
+THREAD_CONTEXT = ThreadContext()
+
+
+class WorkerPool(object):
+    """Admission control of sequence worker processes.
+
+    At most size sequence workers run at once in the whole test, counted
+    by a semaphore created in the master and handed to every worker the
+    pool starts. A run that finds no free slot is queued in the
+    process that asked for it and started by a later poll(), instead of
+    failing the test. Only running sequences hold slots: a worker gives
+    its slot up as soon as its sequence has ended, before it starts the
+    runs it queued and waits for them. The process that started a worker
+    releases the slot if the worker ended without giving it up, such as a
+    killed one. Workers are threads instead of processes if the pool's
+    context is THREAD_CONTEXT."""
+
+    def __init__(self, size=WORKER_POOL_SIZE, slots=None, context=None, held=None):
+        if size < 1:
+            raise ValueError('Worker pool size must be positive: %r' %(size))
+        self.size = size
+        self.context = context or multiprocessing.get_context()
+        self.slots = slots if slots is not None else self.context.BoundedSemaphore(size)
+        self.pending = deque()      # runs waiting for a slot, in order
+        self.running = []           # runs started by this process
+        self.held = held            # flag of the slot this worker holds, None in the master
+
+    def _start(self, run, slot=True):
+        run.held = self.context.Value('b', 1) if slot else None
+        target = run.target
+        if not getattr(self.context, 'threads', False) and \
+                self.context.get_start_method() in SPAWN_METHODS:
+            if self.context.get_start_method() == 'forkserver':
+                start_spawn_server()        # a worker's own, on its first run
+            target = spawn_target(target)   # imported by the worker once it has our settings
+        args = (self.size, self.slots, run.held, target, run.args, self.context)
+        run.process = self.context.Process(target=_run_in_pool, args=args)
+        t_start = time.perf_counter()
+        run.process.start()
+        run.spawn_latency = time.perf_counter() - t_start
+        self.running.append(run)
+        if run.on_start is not None:
+            run.on_start(run)
+
+    def submit(self, target, args=(), on_start=None):
+        '''Start target(*args) in a worker process as soon as a slot is free,
+        return the run, its process is None while pending'''
+        run = PendingRun(target, args, on_start)
+        self.pending.append(run)
+        self.poll()
+        return run
+
+    def run_wait(self, target, args=(), on_start=None):
+        '''Run target(*args) in a worker process and wait for it to end. The
+        caller is blocked meanwhile, so the worker runs in the caller's slot,
+        waiting for a free one could deadlock with the whole pool waiting'''
+        run = PendingRun(target, args, on_start)
+        self._start(run, slot=False)
+        while run.process.is_alive():
+            run.process.join(POOL_POLL_INTERVAL)
+            self.poll()
+        self.poll()
+        return run
+
+    def poll(self):
+        '''Reap ended workers, start pending runs on the slots they free'''
+        if self.running:
+            still = []
+            for run in self.running:
+                if run.process.is_alive():
+                    still.append(run)
+                else:
+                    run.process.join()
+                    if run.held is not None and run.held.value:
+                        run.held.value = 0      # the worker ended still holding its slot
+                        self.slots.release()
+            self.running = still
+
+        while self.pending and self.slots.acquire(False):
+            self._start(self.pending.popleft())
+
+        return len(self.pending)
+
+    def kill(self, run):
+        '''Kill a run, or drop it if still pending'''
+        if run.process is None:
+            try:
+                self.pending.remove(run)
+            except ValueError:
+                pass
+        else:
+            run.kill()
+            if not getattr(self.context, 'threads', False):
+                run.process.join()      # a thread ends after its running command, reaped by poll()
+            self.poll()
+
+    def release(self):
+        '''Give up the slot of this worker, its sequence has ended'''
+        if self.held is not None and self.held.value:
+            self.slots.release()
+            self.held.value = 0
+
+    def start_pending(self):
+        '''Wait until every run submitted by this process has started'''
+        while self.poll():
+            time.sleep(POOL_POLL_INTERVAL)
+
+    def drain(self):
+        '''Wait until every run submitted by this process has started and ended'''
+        while self.pending or self.running:
+            if self.poll() or self.running:
+                time.sleep(POOL_POLL_INTERVAL)
+
+
+THIS_POOL = contextvars.ContextVar('THIS_POOL', default=None)
+
+
+def _run_in_pool(size, slots, held, target, args, context):
+    '''Worker entry, the worker's own runs share the pool's slots and context'''
+    if not callable(target):    # started from a fresh interpreter
+        target = load_spawn_target(target)
+    THIS_POOL.set(WorkerPool(size, slots, context, held))
+    return target(*args)
+
+
+def init_pool(size=WORKER_POOL_SIZE, context=None):
+    '''Create the worker pool, in the master before any worker is started'''
+    this_pool = WorkerPool(size, context=context)
+    THIS_POOL.set(this_pool)
+    return this_pool
+
+
+def get_this_pool():
+    this_pool = THIS_POOL.get()
+    if this_pool is None:
+        this_pool = WorkerPool()
+        THIS_POOL.set(this_pool)
+    return this_pool
@@ -12,6 +12,8 @@ import termios
 import time
 import select
 
+from reactor import Reactor
+
 try:
     import builtins  # Python 3
 except ImportError:
@@ -313,6 +315,10 @@ class PtyProcess(object):
         # Used by terminate() to give kernel time to update process status.
         # Time in seconds.
         self.delayafterterminate = 0.1
+        # Reactor that wakes us up when the pty is readable, may be shared
+        # by a worker watching many ptys, see attach_reactor().
+        self.reactor = None
+        self._own_reactor = False
 
     @classmethod
     def spawn(
@@ -531,6 +537,7 @@ class PtyProcess(object):
         and SIGINT). '''
         if not self.closed:
             self.flush()
+            self.detach_reactor()
             self.fileobj.close() # Closes the file descriptor
             # Give kernel time to update process status.
             time.sleep(self.delayafterclose)
@@ -687,22 +694,91 @@ class PtyProcess(object):
 
         return s
 
+    def attach_reactor(self, reactor=None):
+        """Register the pty fd to reactor, a private one is created if
+        reactor is not given. Return the attached reactor."""
+        if self.reactor is not None:
+            if reactor is None or reactor is self.reactor:
+                return self.reactor
+            self.detach_reactor()
+
+        self.reactor = reactor if reactor is not None else Reactor()
+        self._own_reactor = reactor is None
+        self.reactor.register(self.fd)
+        return self.reactor
+
+    def detach_reactor(self):
+        if self.reactor is not None:
+            self.reactor.unregister(self.fd)
+            if self._own_reactor:
+                self.reactor.close()
+            self.reactor = None
+
+    def wait_readable(self, timeout=None):
+        """Block until the pty is readable, return False if timeout expires
+        first. None timeout blocks forever, 0 timeout returns immediately."""
+        if self.fd < 0: raise EOFError('Invalid file descriptor, %d' %(self.fd))
+        return self.attach_reactor().wait_readable(self.fd, timeout)
+
+    def readinto(self, b):
+        """Read at most ``len(b)`` bytes from the pty into the writable buffer
+        ``b``, return the number of bytes read.
+
+        Can block if there is nothing to read. Raises :exc:`EOFError` if the
+        terminal was closed.
+        """
+        try:
+            n = self.fileobj.readinto1(b)
+        except (OSError, IOError) as err:
+            if err.args[0] == errno.EIO:
+                # Linux-style EOF
+                self.flag_eof = True
+                raise EOFError('End Of File (EOF). Exception style platform.')
+            raise
+        if not n:
+            # BSD-style EOF (also appears to work on recent Solaris (OpenIndiana))
+            self.flag_eof = True
+            raise EOFError('End Of File (EOF). Empty string style platform.')
+
+        return n
+
+    def read_all_into(self, ring, size=4*1024):
+        """Nonblocking read available data from the pseudoterminal straight
+        into ``ring`` (a :class:`ringbuffer.RingBuffer`), return the number of
+        bytes read, 0 if child's fd is not ready.
+
+        At most a quarter of the ring is read per call, so the caller gets to
+        consume the data before the ring wraps over it."""
+        n = 0
+        limit = max(ring.capacity // 4, size)
+        if self.fd < 0: raise EOFError('Invalid file descriptor, %d' %(self.fd))
+        try:
+            while n < limit and self.readable_now():
+                got = ring.readinto(self.readinto, size)
+                if not got:
+                    break
+                n += got
+        except EOFError:
+            pass
+
+        return n
+
+    def readable_now(self):
+        """Return True if the pty can be read without blocking"""
+        return self.wait_readable(0.0)
+
     def read_all_nonblocking(self, size=4*1024):
         """Nonblocking read all available data from the pseudoterminal, 
         return b'' if child's fd is not ready."""
-        s = b''
+        chunks = []
         if self.fd < 0: raise EOFError('Invalid file descriptor, %d' %(self.fd))
         try:
-            while select.select([self.fd,], [], [], 0.0)[0]:
-                s = s + self.read(size=size)
-                time.sleep(0.02)
-            # flush all for ensurance
-            if select.select([self.fd,], [], [], 0.0)[0]:
-                s = s + self.read(size=size*1024)
+            while self.wait_readable(0.0):
+                chunks.append(self.read(size=size))
         except EOFError:
             pass
 
-        return s
+        return b''.join(chunks)
 
     def read_nonblocking(self, size=16):
         """Nonblocking read from pseudoterminal, return b'' if child's fd
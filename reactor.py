@@ -0,0 +1,78 @@
+import select
+import time
+
+
+class Reactor(object):
+    """Event driven reactor, wakes when a watched fd is readable.
+
+    Backed by epoll where available and poll(2) elsewhere. Each agent has
+    its own reactor watching its tty, so a worker blocks in one syscall
+    instead of polling its tty and sleeping in between, and another
+    agent's unread output never wakes it."""
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._events = select.EPOLLIN | select.EPOLLPRI | select.EPOLLERR | select.EPOLLHUP
+            self._scale = 1.0       # epoll timeout is in seconds
+        else:
+            self._poller = select.poll()
+            self._events = select.POLLIN | select.POLLPRI | select.POLLERR | select.POLLHUP
+            self._scale = 1000.0    # poll timeout is in milliseconds
+        self._fds = set()
+        self.closed = False
+
+    def register(self, fd):
+        '''Watch fd for readability'''
+        if fd not in self._fds:
+            self._poller.register(fd, self._events)
+            self._fds.add(fd)
+
+    def unregister(self, fd):
+        if fd in self._fds:
+            self._fds.discard(fd)
+            try:
+                self._poller.unregister(fd)
+            except (OSError, KeyError, ValueError):
+                pass    # fd may be closed already
+
+    def poll(self, timeout=None):
+        '''Block until some fd is readable or timeout elapses, return the
+        list of readable fds, None timeout blocks forever'''
+        if self.closed:
+            raise ValueError('I/O operation on closed reactor')
+
+        if timeout is None:
+            timeout = -1 if self._scale == 1.0 else None
+        else:
+            timeout = max(timeout, 0.0) * self._scale
+        while True:
+            try:
+                return [fd for fd, _ in self._poller.poll(timeout)]
+            except InterruptedError:
+                continue
+
+    def wait_readable(self, fd, timeout=None):
+        '''Wait until fd is readable, return False if timeout expires first.
+        The poller is level triggered, the reactor's other fds, if any, are
+        read by the same agent, or they would wake every wait at once.'''
+        t_end = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            wait = max(t_end - time.monotonic(), 0.0) if t_end is not None else None
+            if fd in self.poll(wait):
+                return True
+            if t_end is not None and time.monotonic() >= t_end:
+                return False
+
+    def close(self):
+        if not self.closed:
+            if hasattr(self._poller, 'close'):
+                self._poller.close()
+            self._fds = set()
+            self.closed = True
+
+    def __del__(self):
+        try:
+            self.close()
+        except:
+            pass
@@ -0,0 +1,86 @@
+DEFAULT_CAPACITY = 1024*1024     # default ring buffer size per session, in bytes
+
+
+class RingBuffer(object):
+    """Preallocated byte buffer capturing a tty output stream.
+
+    Data is read straight into the buffer with readinto() and addressed by
+    absolute stream offsets, so readers (matchers, logger, error capture)
+    take memoryviews of it instead of making their own copies. When the
+    buffer runs out of room the newest half is moved to the front and older
+    data is dropped, which keeps every view contiguous and costs amortized
+    O(1) per byte. Views are valid until the next write into the buffer."""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._buf = bytearray(capacity)
+        self._mv = memoryview(self._buf)
+        self._lo = 0            # physical index of the oldest retained byte
+        self._hi = 0            # physical index past the newest byte
+        self._base = 0          # absolute stream offset of the oldest retained byte
+
+    def __len__(self):
+        return self._hi - self._lo
+
+    @property
+    def start(self):
+        '''absolute offset of the oldest byte still retained'''
+        return self._base
+
+    def tell(self):
+        '''absolute offset past the newest byte'''
+        return self._base + self._hi - self._lo
+
+    def _reserve(self, size):
+        if self.capacity - self._hi < size:
+            size = min(size, self.capacity)
+            keep = min(self._hi - self._lo, self.capacity // 2, self.capacity - size)
+            lo = self._hi - keep
+            self._buf[0:keep] = self._buf[lo:self._hi]
+            self._base += lo - self._lo
+            self._lo, self._hi = 0, keep
+
+        return self._mv[self._hi:self._hi+size]
+
+    def readinto(self, readinto, size=4*1024):
+        '''Fill the buffer by readinto(memoryview) -> nbytes, return nbytes'''
+        n = readinto(self._reserve(size))
+        if n:
+            self._hi += n
+        return n or 0
+
+    def write(self, data):
+        data = memoryview(data)
+        while data:
+            room = self._reserve(min(len(data), self.capacity // 2 or 1))
+            n = len(room)
+            room[:] = data[:n]
+            self._hi += n
+            data = data[n:]
+
+    def _phys(self, offset, default):
+        if offset is None:
+            return default
+        offset = min(max(offset, self._base), self.tell())
+        return self._lo + offset - self._base
+
+    def view(self, begin=None, end=None):
+        '''memoryview of stream bytes [begin, end), clamped to retained data'''
+        return self._mv[self._phys(begin, self._lo):self._phys(end, self._hi)]
+
+    def tail(self, size):
+        return self.view(self.tell() - size)
+
+    def find(self, sub, begin=None, end=None):
+        '''absolute offset of sub in [begin, end), -1 if not found'''
+        pos = self._buf.find(sub, self._phys(begin, self._lo), self._phys(end, self._hi))
+        return pos - self._lo + self._base if pos >= 0 else -1
+
+    def rfind(self, sub, begin=None, end=None):
+        pos = self._buf.rfind(sub, self._phys(begin, self._lo), self._phys(end, self._hi))
+        return pos - self._lo + self._base if pos >= 0 else -1
+
+    def clear(self):
+        '''drop all data, stream offsets keep counting'''
+        self._base = self.tell()
+        self._lo = self._hi = 0
@@ -1,11 +1,61 @@
 
+import gc
+import contextvars
+import os
+import json
+import hmac
+import pickle
+import hashlib
+import tempfile
+from array import array
+from itertools import islice
+
 import utils
 import command
+from globs import *
 from errors import *
 from command import ShellCmd, BuiltinCmd
 
-THIS_SEQUENCE_FILE = ''
-THIS_SEQUENCE_READER = None
+# the sequence being parsed, per process or per thread of the thread backend
+THIS_SEQUENCE_FILE = contextvars.ContextVar('THIS_SEQUENCE_FILE', default='')
+THIS_SEQUENCE_READER = contextvars.ContextVar('THIS_SEQUENCE_READER', default=None)
+PARSED_SEQUENCES = {}           # absolute sequence path -> parsed SequenceReader, inherited by forked workers
+SEQUENCE_CACHE_VERSION = 5      # bump when parsed command layout changes, invalidates caches
+SEQUENCE_CACHE_KEY = None       # secret the cached sequences are signed with, read once
+STREAM_LINE_CACHE = 4096        # distinct lines whose commands are reused while streaming
+
+class CommandStore(object):
+    """Compact command sequence. Parsed commands are immutable and carry no
+    run output, so identical sequence lines share one command object, and
+    the sequence itself is an array of indexes into that command table."""
+    __slots__ = ('table', 'order')
+
+    def __init__(self, table=None, order=None):
+        self.table = table if table is not None else []     # unique commands
+        self.order = order if order is not None else array('I')
+
+    def append(self, command):
+        '''append a new command, return its table index'''
+        index = len(self.table)
+        self.table.append(command)
+        self.order.append(index)
+        return index
+
+    def append_index(self, index):
+        self.order.append(index)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):    # subsequences share the command table
+            return CommandStore(self.table, self.order[i])
+        return self.table[self.order[i]]
+
+    def __iter__(self):
+        table = self.table
+        return (table[i] for i in self.order)
+
 
 class SequenceReader(object):
     """Read and parse commands from a sequence file"""
@@ -13,12 +63,16 @@ class SequenceReader(object):
     comment_header = '#'
 
     def __init__(self, fname):
-        self.fname = utils.fix_seqfile_path(fname)
+        self.fname = fname              # resolved by the caller, RUN commands hold resolved paths
         self.fp = None
-        self.sequence = []
+        self.sequence = CommandStore()
         self.subsequence_probe = None
         self.subsequences = {}
         self.cmd_counter = 0
+        self.streaming = False          # if commands are parsed on demand by stream()
+        self.subsequence_spans = {}     # symbol -> (start, end) file offsets, when streaming
+        self.stream_offset = 0          # file offset past the last line streamed
+        self.line_offset = 0            # file offset of the line being parsed, when streaming
 
     def strip_line_comment(self, line):
         pos = line.find(self.comment_header)
@@ -32,10 +86,26 @@ class SequenceReader(object):
         if self.fp is None:
             self.fp = open(self.fname, mode=mode)
 
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
     def lines(self):
         self.open()
-        concat = ''
-        for line in self.fp:
+        fp = self.fp
+        try:
+            yield from self.join_lines(fp)
+        finally:
+            fp.close()
+            if self.fp is fp:
+                self.fp = None
+
+    def join_lines(self, rawlines):
+        '''sequence lines of raw file lines, comments and null lines dropped,
+        continued lines joined'''
+        concat = []     # continued lines, joined once the last one is read
+        for line in rawlines:
             line = utils.STR(line)
             line = self.strip_line_comment(line)   # skip comments
 
@@ -43,38 +113,343 @@ class SequenceReader(object):
                 continue
 
             if line[-1] == self.continue_nextline: # need to concatenate next line
-                concat = concat + line[:-1]
+                concat.append(line[:-1])
                 continue
 
-            concat = concat + line
-            yield concat
-            concat = ''
+            if concat:
+                concat.append(line)
+                line = ''.join(concat)
+                concat = []
+            yield line
 
-        self.fp.close()
-        self.fp = None
+    def stream_lines(self, start=0, end=None, readahead=STREAM_LOOKAHEAD):
+        '''sequence lines between file offsets start and end, raw lines are
+        read readahead at a time, stream_offset follows the lines handed out'''
+        def rawlines(fp):
+            offset = start
+            while end is None or offset < end:
+                batch = list(islice(fp, readahead))
+                if not batch:
+                    return
+                for line in batch:
+                    offset += len(line)
+                    self.stream_offset = offset
+                    yield line
+                    if end is not None and offset >= end:
+                        return
+
+        with open(self.fname, mode='rb') as fp:   # also closed when a stream is abandoned halfway
+            fp.seek(start)
+            self.stream_offset = start
+            yield from self.join_lines(rawlines(fp))
+
+    def cache_path(self):
+        digest = hashlib.sha1(utils.BYTES(os.path.abspath(self.fname))).hexdigest()
+        return os.path.join(SEQUENCE_CACHE_DIR, digest + '.cache')
+
+    def content_digest(self):
+        with open(self.fname, mode='rb') as fp:
+            return hashlib.sha1(fp.read()).hexdigest()
+
+    def load_cache(self):
+        '''Load the parsed sequence from cache, return False if there is no
+        valid cache. The cache is keyed by path, mtime and content hash, the
+        content is only hashed if mtime or size has changed.'''
+        key = get_cache_key()
+        if key is None:
+            return False
+        cachefile = self.cache_path()
+        try:
+            st = os.stat(self.fname)
+            with open(cachefile, mode='rb') as fp:
+                headline = fp.readline()
+                signature = fp.readline().rstrip(b'\n')
+                payload = fp.read()
+            # the header is plain json, only a payload signed with our key is unpickled
+            header = json.loads(utils.STR(headline))
+            if header['VERSION'] != SEQUENCE_CACHE_VERSION or \
+                    header['PATH'] != os.path.abspath(self.fname):
+                return False
+            if not hmac.compare_digest(signature, sign_cache(key, headline, payload)):
+                return False
+            if (header['MTIME'], header['SIZE']) != (st.st_mtime_ns, st.st_size):
+                if header['DIGEST'] != self.content_digest():
+                    return False
+                touched = True  # same content, refresh the cache key later
+            else:
+                touched = False
+            self.sequence, self.subsequences, self.cmd_counter = pickle.loads(payload)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError, ImportError,
+                EOFError, pickle.UnpicklingError):
+            return False
+
+        if touched:
+            self.dump_cache()
+        return True
+
+    def dump_cache(self):
+        '''Save the parsed sequence to cache, a stale or failed cache is harmless'''
+        key = get_cache_key()
+        if key is None:
+            return
+        try:
+            st = os.stat(self.fname)
+            header = {
+                'VERSION': SEQUENCE_CACHE_VERSION,
+                'PATH': os.path.abspath(self.fname),
+                'MTIME': st.st_mtime_ns,
+                'SIZE': st.st_size,
+                'DIGEST': self.content_digest(),
+                }
+            headline = utils.BYTES(json.dumps(header)) + b'\n'
+            payload = pickle.dumps((self.sequence, self.subsequences, self.cmd_counter),
+                                   protocol=pickle.HIGHEST_PROTOCOL)
+            fd, tmpfile = tempfile.mkstemp(dir=SEQUENCE_CACHE_DIR)
+            with os.fdopen(fd, mode='wb') as fp:
+                fp.write(headline)
+                fp.write(sign_cache(key, headline, payload) + b'\n')
+                fp.write(payload)
+            os.replace(tmpfile, self.cache_path())  # atomic, concurrent workers never see half a cache
+        except (OSError, pickle.PicklingError):
+            pass
 
     def parse_lines(self):
-        # update globals only when we start parsing
-        global THIS_SEQUENCE_READER, THIS_SEQUENCE_FILE
-        THIS_SEQUENCE_FILE = self.fname
-        THIS_SEQUENCE_READER = self
+        # update globals only while parsing, RUNs of the file are resolved
+        # against it, later lookups must not be
+        seqfile = THIS_SEQUENCE_FILE.set(self.fname)
+        seqreader = THIS_SEQUENCE_READER.set(self)
+        try:
+            if SEQUENCE_CACHE_ENABLED and self.load_cache():
+                return
+
+            self.tokenize_lines()
+
+            if SEQUENCE_CACHE_ENABLED:
+                self.dump_cache()
+        finally:
+            THIS_SEQUENCE_FILE.reset(seqfile)
+            THIS_SEQUENCE_READER.reset(seqreader)
+
+    def begin_subsequence(self, symbol):
+        # a streamed subsequence is located by file offsets, past this line
+        self.subsequence_probe = (symbol, self.stream_offset if self.streaming else self.cmd_counter)
+
+    def end_subsequence(self):
+        symbol, start = self.subsequence_probe
+        self.subsequence_probe = None
+        if not self.streaming:
+            self.subsequences[symbol] = self.sequence[start:]
+            return
+
+        self.subsequence_spans[symbol] = (start, self.line_offset)
+        if symbol in self.subsequences:     # redefined after LOOP referred to it
+            self.subsequences[symbol] = self.load_subsequence(symbol)
+
+    def has_subsequence(self, symbol):
+        '''If symbol is defined, a streamed subsequence is buffered once LOOP refers to it'''
+        if symbol not in self.subsequences and symbol in self.subsequence_spans:
+            self.subsequences[symbol] = self.load_subsequence(symbol)
+        return symbol in self.subsequences
+
+    def load_subsequence(self, symbol):
+        '''Parse a streamed subsequence again from its span of the file'''
+        state = (self.stream_offset, self.line_offset, self.cmd_counter)
+        subsequence = CommandStore()
+        for cmd in self.parse_stream(*self.subsequence_spans[symbol]):
+            subsequence.append(cmd)
+        self.stream_offset, self.line_offset, self.cmd_counter = state
+        return subsequence
+
+    def stream(self, lookahead=STREAM_LOOKAHEAD):
+        '''Parse commands on demand and yield each as soon as it is parsed,
+        raw lines are read lookahead at a time. Memory stays flat however
+        long the file is, only subsequences LOOP refers to are buffered.'''
+        THIS_SEQUENCE_FILE.set(self.fname)
+        THIS_SEQUENCE_READER.set(self)
+
+        self.streaming = True
+        self.subsequences.clear()   # the worker running the stream holds this dict
+        self.subsequence_spans.clear()
+        self.subsequence_probe = None
+        self.cmd_counter = 0
+
+        return self.parse_stream(readahead=lookahead)
 
+    def parse_stream(self, start=0, end=None, readahead=STREAM_LOOKAHEAD):
+        commands = {}   # recent distinct lines -> command, bounded
+        self.line_offset = start
+        for seqline in self.stream_lines(start, end, readahead):
+            cmd = commands.get(seqline)
+            if cmd is None:
+                cmd = BuiltinCmd.discovery(seqline)
+                if cmd is None:
+                    cmd = ShellCmd(command.make_shellcmd_args_by_line(seqline))
+                elif not cmd.is_seq_cmd:    # SUBSEQUENCE marks, never reused
+                    self.line_offset = self.stream_offset
+                    continue
+                if len(commands) >= STREAM_LINE_CACHE:
+                    commands.clear()
+                commands[seqline] = cmd
+
+            self.line_offset = self.stream_offset   # where the next line begins
+            self.cmd_counter += 1
+            yield cmd
+
+    def tokenize_lines(self):
+        indexes = {}    # sequence line -> table index, only while tokenizing
         for seqline in self.lines():
+            index = indexes.get(seqline)
+            if index is not None:   # same line parsed before, share its command
+                self.sequence.append_index(index)
+                self.cmd_counter += 1
+                continue
+
             builtincmd = BuiltinCmd.discovery(seqline)  # check if this a builtin command first
             if builtincmd:
                 if builtincmd.is_seq_cmd:
-                    self.sequence.append(builtincmd)
+                    indexes[seqline] = self.sequence.append(builtincmd)
                     self.cmd_counter += 1
             else:
                 shellargs = command.make_shellcmd_args_by_line(seqline)
-                self.sequence.append(ShellCmd(shellargs))
+                indexes[seqline] = self.sequence.append(ShellCmd(shellargs))
                 self.cmd_counter += 1
 
 
 
+class SequenceStream(object):
+    """Sequence of a file parsed lazily, every iteration streams the file
+    again, so it can stand in for a CommandStore when running loops."""
+    __slots__ = ('reader', 'lookahead')
+
+    def __init__(self, reader, lookahead=STREAM_LOOKAHEAD):
+        self.reader = reader
+        self.lookahead = lookahead
+
+    def __iter__(self):
+        return self.reader.stream(self.lookahead)
+
+
+class LoopFrame(object):
+    """One level of the loop interpreter, a sequence run for some loops.
+    Every frame keeps its own counters, so nested loops don't clobber the
+    loops they run in."""
+    __slots__ = ('sequence', 'loops', 'cmplt_loops', 'commands', 'symbol')
+
+    def __init__(self, sequence, loops, symbol=None):
+        self.sequence = sequence
+        self.loops = loops
+        self.cmplt_loops = 0            # how many loops that has completed
+        self.commands = iter(sequence)  # commands left of the running loop
+        self.symbol = symbol            # subsequence symbol, None for the test loops
+
+
+class LoopInterpreter(object):
+    """Runs a sequence and the LOOPs in it on a stack of frames instead of
+    recursing, the bottom frame runs the test loops. Sequence workers and
+    async sessions step through their commands with it."""
+    __slots__ = ()
+
+    def push_frame(self, sequence, loops, symbol=None):
+        '''run sequence for loops from the next command on, used by LOOP'''
+        if loops > 0:
+            self.frames.append(LoopFrame(sequence, loops, symbol))
+
+    def next_command(self):
+        '''Next command to run, None once all loops have run. loop_done is
+        called when a test loop has run all its commands, before it counts.'''
+        while self.frames:
+            frame = self.frames[-1]
+            # the sequence may be a stream so it's only iterated
+            command = next(frame.commands, None)
+            if command is not None:
+                return command
+            if frame is self.frames[0]:
+                self.loop_done()
+            # ahead to next loop
+            frame.cmplt_loops += 1
+            if frame.cmplt_loops < frame.loops:
+                frame.commands = iter(frame.sequence)
+            else:
+                self.frames.pop()
+
+        return None
+
+    def loop_done(self):
+        pass
+
+
+def get_parsed_seqreader(fname):
+    '''Return the parsed SequenceReader of fname, parse it if it wasn't
+    preloaded. fname is resolved by the caller, as RUN commands hold them'''
+    path = os.path.abspath(fname)
+    seqreader = PARSED_SEQUENCES.get(path)
+    if seqreader is None:
+        seqreader = SequenceReader(fname)
+        seqreader.parse_lines()
+        PARSED_SEQUENCES[path] = seqreader
+
+    return seqreader
+
+
+def preload_sequences(fname):
+    '''Parse fname and every sequence it starts by RUN/RUN_WAIT, then freeze
+    the heap. Workers forked afterwards inherit the parsed commands and
+    their plans copy-on-write and never parse, and since frozen objects
+    are ignored by the garbage collector, collections in the workers don't
+    write to (and so copy) the pages holding them.'''
+    pending = [fname]
+    while pending:
+        seqreader = get_parsed_seqreader(pending.pop())
+        for cmd in seqreader.sequence.table:
+            seq_file = getattr(cmd, 'seq_file', None)
+            if seq_file and os.path.abspath(seq_file) not in PARSED_SEQUENCES:
+                pending.append(seq_file)
+
+    gc.collect()
+    gc.freeze()
+
+
+def sign_cache(key, headline, payload):
+    return utils.BYTES(hmac.new(key, headline + payload, hashlib.sha256).hexdigest())
+
+
+def get_cache_key():
+    '''Secret of this user the cached sequences are signed with, kept in the
+    cache directory. None if the directory isn't private to the user, the
+    cache isn't used then.'''
+    global SEQUENCE_CACHE_KEY
+    if SEQUENCE_CACHE_KEY is not None:
+        return SEQUENCE_CACHE_KEY
+
+    keyfile = os.path.join(SEQUENCE_CACHE_DIR, 'key')
+    try:
+        os.makedirs(SEQUENCE_CACHE_DIR, mode=0o700, exist_ok=True)
+        st = os.stat(SEQUENCE_CACHE_DIR)
+        if st.st_uid != os.getuid() or st.st_mode & 0o077:
+            return None
+        if not os.path.exists(keyfile):
+            fd, tmpfile = tempfile.mkstemp(dir=SEQUENCE_CACHE_DIR)  # created 0600
+            try:
+                with os.fdopen(fd, mode='wb') as fp:
+                    fp.write(os.urandom(32))
+                os.link(tmpfile, keyfile)   # the first worker to get there wins
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmpfile)
+        with open(keyfile, mode='rb') as fp:
+            key = fp.read()
+    except OSError:
+        return None
+
+    if len(key) == 32:
+        SEQUENCE_CACHE_KEY = key
+    return SEQUENCE_CACHE_KEY
+
+
 def get_this_seqfile():
-    return THIS_SEQUENCE_FILE
+    return THIS_SEQUENCE_FILE.get()
 
 
 def get_this_seqreader():
-    return THIS_SEQUENCE_READER
+    return THIS_SEQUENCE_READER.get()
@@ -0,0 +1,13 @@
+"""First module the spawn server imports. It applies the master's settings
+and parses the master's sequences before the core modules are imported,
+see spawnserver.start_spawn_server(). Other processes don't have
+SPAWN_ENV set, for them importing this module does nothing."""
+import os
+import json
+
+import spawnserver
+
+
+spawned = os.environ.pop(spawnserver.SPAWN_ENV, None)
+if spawned:
+    spawnserver.preload_spawn_server(*json.loads(spawned))
@@ -0,0 +1,123 @@
+import os
+import json
+import importlib
+import multiprocessing
+from multiprocessing import forkserver
+
+import globs
+
+
+# globs settings a worker started from a fresh interpreter applies before
+# importing the core modules, they take them by `from globs import *`
+SPAWN_SETTINGS = (
+    'LOGGING_ENABLED',
+    'STOP_ON_FAILURE',
+    'DEBUG_MODE_ON',
+    'LOOP_ITERATIONS',
+    'MAIN_SEQUENCE_FILE',
+    'SEQUENCE_CACHE_ENABLED',
+    'SEQUENCE_STREAMING',
+    'STREAM_LOOKAHEAD',
+    'WORKER_POOL_SIZE',
+    'LOOP_SHARDS',
+    'LOOP_TARGETS',
+    )
+# modules the spawn server imports once for all workers, none of them reads
+# the settings when imported
+SPAWN_PRELOAD = ['utils', 'reactor', 'ringbuffer', 'ptyprocess', 'matcher', 'stats', 'pool']
+# start methods whose workers don't inherit the memory of their starter
+SPAWN_METHODS = ('forkserver', 'spawn')
+# environment of the spawn server only: the master's settings and main
+# sequence, taken by the spawnpreload module, the first the server imports
+SPAWN_ENV = 'AUTOSEQ_SPAWN_SERVER'
+SPAWN_SEQUENCE = None           # main sequence the spawn servers preload
+SPAWN_SERVER_PID = None         # process that started its spawn server
+
+
+def start_spawn_server(sequence_file=None):
+    '''Start the spawn server of this process, unless it's running, return
+    its multiprocessing context for the worker pool.
+
+    The server is a forkserver process started from a fresh interpreter,
+    before the master opens any pty. It imports SPAWN_PRELOAD, then every
+    worker is forked from it, so workers start clean, without the pty, log
+    files or state of the process asking for them. The server finds the
+    modules through PYTHONPATH, CPython 3.11 doesn't give it our sys.path.
+    Unless streaming, the server also parses the main sequence and the
+    sequences it RUNs, then freezes its heap, so workers start with them
+    parsed and share them copy-on-write.
+
+    A forkserver can't be shared with the processes it forked through the
+    public API, so a worker's RUNs start from a server of the worker's own,
+    started by its pool on its first RUN and preloaded the same way. That
+    costs a worker running RUNs one interpreter start, once for all its
+    RUNs.'''
+    global SPAWN_SEQUENCE, SPAWN_SERVER_PID
+    if sequence_file is not None:
+        SPAWN_SEQUENCE = sequence_file
+    context = multiprocessing.get_context('forkserver')
+    if SPAWN_SERVER_PID == os.getpid():
+        return context
+
+    context.set_forkserver_preload(['spawnpreload'] + SPAWN_PRELOAD)
+    env = {'PYTHONPATH': os.pathsep.join(filter(None, (os.path.abspath(globs.TOPDIR),
+                                                       os.environ.get('PYTHONPATH'))))}
+    if SPAWN_SEQUENCE and not globs.SEQUENCE_STREAMING:
+        env[SPAWN_ENV] = json.dumps((spawn_settings(), SPAWN_SEQUENCE))
+    saved = dict((name, os.environ.get(name)) for name in env)
+    os.environ.update(env)
+    try:
+        forkserver.ensure_running()
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+    SPAWN_SERVER_PID = os.getpid()
+    return context
+
+
+def preload_spawn_server(settings, sequence_file):
+    '''Apply the master's settings in the spawn server, then parse its
+    sequences, the workers forked from it start their servers the same way'''
+    global SPAWN_SEQUENCE
+    SPAWN_SEQUENCE = sequence_file
+    apply_spawn_settings(settings)
+    import sequence
+    try:
+        sequence.preload_sequences(sequence_file)
+    except Exception:
+        pass    # the worker parsing it reports the error
+
+
+def spawn_settings():
+    '''globs settings of this process, for a fresh interpreter'''
+    return dict((name, getattr(globs, name)) for name in SPAWN_SETTINGS)
+
+
+def apply_spawn_settings(settings):
+    for name in SPAWN_SETTINGS:
+        setattr(globs, name, settings[name])
+
+
+def spawn_target(target):
+    '''Reference of target for a worker started from a fresh interpreter,
+    with the settings of this process, resolved by load_spawn_target()'''
+    import uds
+    settings = spawn_settings()
+    settings['UDS'] = uds.get_this_uds().uds
+    return (settings, target.__module__, target.__name__)
+
+
+def load_spawn_target(spawned):
+    '''Apply the settings of the worker's starter, then import its target,
+    the core modules must not be imported before'''
+    settings, module, name = spawned
+    apply_spawn_settings(settings)
+
+    import uds
+    if settings['UDS']:
+        uds.set_this_uds(settings['UDS'])
+
+    return getattr(importlib.import_module(module), name)
@@ -25,12 +25,38 @@ parser.add_argument('-l', metavar='Loop iterations', nargs='?',
                     default=1, type=int, dest='loops',
                     help='Specify loop iterations for the main sequence file specified by -l option.')
 
+parser.add_argument('-k', '--shards', metavar='Loop shards', nargs='?',
+                    default=1, type=int, dest='shards',
+                    help='Split the loop iterations of the main sequence across parallel workers.')
+
+parser.add_argument('-t', '--targets', metavar='Targets', nargs='?', default='', dest='targets',
+                    help='Comma separated targets, one shard per target, exported to shells as $%s.' %(globs.TARGET_ENV))
+
+parser.add_argument('-w', '--workers', metavar='Worker pool size', nargs='?',
+                    default=globs.WORKER_POOL_SIZE, type=int, dest='workers',
+                    help='Specify how many sequence workers may run at once, more RUNs wait for a free worker.')
+
+parser.add_argument('-b', '--backend', metavar='Worker backend', nargs='?',
+                    default=globs.WORKER_BACKEND, choices=('process', 'thread'), dest='backend',
+                    help='Run sequence workers as processes or as threads of one process, for sequences waiting on remote consoles.')
+
+parser.add_argument('-a', '--async-sessions', metavar='Sessions', nargs='?',
+                    default=0, const=1, type=int, dest='async_sessions',
+                    help='Run the main sequence on this many console sessions in one process, one per target if targets are given. '
+                         'Sequences with RUN, RUN_WAIT, PASSWD, FIND or PULSE are refused.')
+
 parser.add_argument('-S', '--stop-on-failure', dest='stop_on_failure',
                     action='store_true', help='Stop the test when failure occurs.')
 
 parser.add_argument('-L', '--enable-logging', dest='logging_enabled',
                     action='store_true', help='Enable file logging.')
 
+parser.add_argument('-N', '--no-sequence-cache', dest='sequence_cache_disabled',
+                    action='store_true', help='Always parse sequence files, don\'t use cached ones.')
+
+parser.add_argument('-s', '--stream', dest='sequence_streaming',
+                    action='store_true', help='Parse sequences on demand while running, for very large sequence files.')
+
 parser.add_argument('-D', '--debug-mode', dest='debug_mode_on',
                     action='store_true', help='Enable debug mode.')
 
@@ -44,6 +70,13 @@ globs.LOGGING_ENABLED = options.logging_enabled
 globs.STOP_ON_FAILURE = options.stop_on_failure
 globs.LOOP_ITERATIONS = options.loops
 globs.DEBUG_MODE_ON = options.debug_mode_on
+globs.SEQUENCE_CACHE_ENABLED = not options.sequence_cache_disabled
+globs.SEQUENCE_STREAMING = options.sequence_streaming
+globs.WORKER_POOL_SIZE = options.workers
+globs.LOOP_TARGETS = tuple(t.strip() for t in options.targets.split(',') if t.strip())
+globs.LOOP_SHARDS = len(globs.LOOP_TARGETS) or options.shards
+globs.WORKER_BACKEND = options.backend
+globs.ASYNC_SESSIONS = options.async_sessions
 
 # check folders
 if not os.path.isdir('./test_sequences'): os.mkdir('./test_sequences')
@@ -55,13 +88,19 @@ if not os.path.isdir('./csvdump'): os.mkdir('./csvdump')
 
 from worker import start_master
 from worker import run_sequence_worker
+from utils import fix_seqfile_path
 
 if __name__ == '__main__':
+    # sequence files are resolved once, RUNs by the parser
+    main_sequence_file = fix_seqfile_path(globs.MAIN_SEQUENCE_FILE)
     # Display tool information before launching
     print('\n%s, Version: %s' %(NAME, VERSION))
     print('UCS Server Testing Automation Tool.')
     print('Author: ' + AUTHOR)
-    if globs.DEBUG_MODE_ON: # no window refreshing
-        run_sequence_worker(globs.MAIN_SEQUENCE_FILE, globs.LOOP_ITERATIONS)
+    if globs.ASYNC_SESSIONS:  # all sessions in this process
+        from asyncagent import run_async_sequences
+        run_async_sequences(main_sequence_file, globs.LOOP_ITERATIONS, globs.ASYNC_SESSIONS, globs.LOOP_TARGETS)
+    elif globs.DEBUG_MODE_ON: # no window refreshing
+        run_sequence_worker(main_sequence_file, globs.LOOP_ITERATIONS)
     else:
-        start_master(globs.MAIN_SEQUENCE_FILE, globs.LOOP_ITERATIONS)
+        start_master(main_sequence_file, globs.LOOP_ITERATIONS, globs.LOOP_SHARDS, globs.LOOP_TARGETS)
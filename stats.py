@@ -0,0 +1,128 @@
+import time
+import contextvars
+from multiprocessing.sharedctypes import RawArray
+
+from globs import *
+
+
+# fields of a worker's slot, all doubles, a slot fills one 64 bytes cache line
+SLOT_SEQ = 0            # odd while the worker is updating the slot
+SLOT_PASS = 1           # loops passed
+SLOT_FAIL = 2           # loops failed
+SLOT_LOOP = 3           # running test loop
+SLOT_COMMAND = 4        # index of the running command in its loop
+SLOT_T_START = 5        # time the worker started, seconds since the epoch
+SLOT_T_UPDATE = 6       # time of the last update
+SLOT_SIZE = 8
+
+STATS_READ_RETRY = 100  # reads of a slot being updated before taking it as is
+
+
+class StatsSlot(object):
+    """Writer of one worker's slot in the stats table.
+
+    Only the worker owning the slot writes it, so updates take no lock: the
+    sequence field is made odd before and even after every update, and a
+    reader seeing it odd or changed reads the slot again."""
+    __slots__ = ('array', 'base')
+
+    def __init__(self, array, index):
+        self.array = array
+        self.base = index * SLOT_SIZE
+
+    def update(self, field, value, increment=False):
+        a = self.array
+        base = self.base
+        a[base + SLOT_SEQ] += 1
+        if increment:
+            a[base + field] += value
+        else:
+            a[base + field] = value
+        a[base + SLOT_T_UPDATE] = time.time()
+        a[base + SLOT_SEQ] += 1
+
+    def start(self, first_loop=1):
+        now = time.time()
+        self.update(SLOT_T_START, now)
+        self.update(SLOT_LOOP, first_loop)
+
+    def loop_passed(self):
+        self.update(SLOT_PASS, 1, increment=True)
+
+    def loop_failed(self):
+        self.update(SLOT_FAIL, 1, increment=True)
+
+    def running(self, loop, command):
+        '''record the running loop and command, one update per command'''
+        a = self.array
+        base = self.base
+        a[base + SLOT_SEQ] += 1
+        a[base + SLOT_LOOP] = loop
+        a[base + SLOT_COMMAND] = command
+        a[base + SLOT_T_UPDATE] = time.time()
+        a[base + SLOT_SEQ] += 1
+
+
+class StatsTable(object):
+    """Loop counters of all workers in shared memory, one fixed size slot
+    per worker. The table is created by the master and handed to every
+    worker started, each worker writes its own slot and the master reads
+    them directly, only failure details still go over the uds."""
+
+    def __init__(self, size=MAX_STATS_SLOTS, context=None):
+        self.size = size
+        self.array = RawArray('d', size * SLOT_SIZE)    # zeroed
+        self.next_id = RawArray('l', 1)
+        self.lock = context.Lock() if context is not None else None
+
+    def alloc(self):
+        '''Assign a new worker its id, unique in the test. The first size
+        workers have the slot of their id, the others have none.'''
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            worker_id = self.next_id[0]
+            self.next_id[0] = worker_id + 1
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+        return worker_id
+
+    def has_slot(self, worker_id):
+        return worker_id is not None and worker_id < self.size
+
+    def slot(self, worker_id):
+        '''Writer of the worker's slot, None if it has none'''
+        return StatsSlot(self.array, worker_id) if self.has_slot(worker_id) else None
+
+    def read(self, index):
+        '''Consistent copy of the fields of slot index, as a list'''
+        a = self.array
+        base = index * SLOT_SIZE
+        for i in range(STATS_READ_RETRY):
+            seq = a[base + SLOT_SEQ]
+            fields = a[base:base + SLOT_SIZE]
+            if seq % 2 == 0 and a[base + SLOT_SEQ] == seq:
+                break
+
+        return fields
+
+
+THIS_STATS = contextvars.ContextVar('THIS_STATS', default=None)
+
+
+def init_stats(size=MAX_STATS_SLOTS, context=None):
+    '''Create the stats table, in the master before any worker is started'''
+    this_stats = StatsTable(size, context)
+    THIS_STATS.set(this_stats)
+    return this_stats
+
+
+def set_this_stats(stats):
+    THIS_STATS.set(stats)
+    return stats
+
+
+def get_this_stats():
+    return THIS_STATS.get()
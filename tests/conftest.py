@@ -0,0 +1,21 @@
+import os
+import sys
+import subprocess
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+
+def run_test(cwd, *args, timeout=60, cache_home=None):
+    '''run start.py in cwd, return its output, sequences are cached in
+    cache_home if given, not at all otherwise'''
+    cmd = [sys.executable, os.path.join(TOPDIR, 'start.py')] + list(args)
+    env = dict(os.environ)
+    if cache_home:
+        env['XDG_CACHE_HOME'] = cache_home
+    else:
+        cmd.insert(2, '-N')
+    result = subprocess.run(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True, timeout=timeout)
+    assert result.returncode == 0, result.stdout
+    return result.stdout
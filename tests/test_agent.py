@@ -0,0 +1,42 @@
+import time
+
+import pytest
+
+from agent import AgentWrapper
+from command import ShellCmd, make_shellcmd_args_by_line
+from errors import ExpectFailure
+
+
+def shell_command(line):
+    return ShellCmd(make_shellcmd_args_by_line(line))
+
+
+@pytest.fixture
+def agent():
+    agent = AgentWrapper()
+    yield agent
+    agent.exit()
+
+
+def test_exec_runs_shell_commands(agent):
+    '''a shell command runs in the agent's shell, its expects are probed'''
+    assert 'hello' in agent.exec(shell_command('echo hello; hello; 5'))
+    agent.exec(shell_command('X=1'))   # one shell runs all commands
+    assert 'x=1' in agent.exec(shell_command('echo x=$X; x=1; 5'))
+    with pytest.raises(ExpectFailure, match='Expects not found'):
+        agent.exec(shell_command('echo nope; absent; 5'))
+
+
+def test_exec_checks_error_messages(agent):
+    '''shell error messages fail a command, unless it is a bypassed one'''
+    with pytest.raises(ExpectFailure, match='no such file or directory'):
+        agent.exec(shell_command('cat /nonexistent; ; ; 5'))
+    agent.exec(shell_command('ls /nonexistent; ; ; 5'))
+
+
+def test_escape_ends_probe(agent):
+    '''an escape found ends the command before its prompt'''
+    t_start = time.monotonic()
+    output = agent.exec(shell_command('echo going && sleep 30; gone; going; 60'))
+    assert 'going' in output
+    assert time.monotonic() - t_start < 10
@@ -0,0 +1,31 @@
+import pytest
+
+from asyncagent import AsyncAgent, AsyncSession
+from conftest import run_test
+from errors import SequenceError
+from sequence import SequenceReader
+
+
+def test_sessions_run_nested_loops(tmp_path):
+    '''sessions run the test loops and the LOOPs in them with the workers' interpreter'''
+    (tmp_path / 'main.seq').write_text('SUBSEQUENCE s\necho x >> count.$AUTOSEQ_TARGET; ; 5\nENDSUBSEQUENCE\n'
+                                       'LOOP s 3\n')
+    output = run_test(str(tmp_path), '-f', 'main.seq', '-l', '2', '-t', 'a,b', '-a')
+    assert 'main#0: 2 success, 0 failure' in output, output
+    assert 'main#1: 2 success, 0 failure' in output, output
+    for target in 'ab':
+        # the subsequence runs in place, then 3 times by LOOP, in each loop
+        assert (tmp_path / ('count.' + target)).read_text() == 'x\n' * 8
+
+
+@pytest.mark.parametrize('line', ['RUN child.seq', 'RUN_WAIT child.seq', 'PASSWD secret',
+                                  'FIND x.txt /tmp,/var', 'PULSE'])
+def test_unsupported_commands_refused(tmp_path, monkeypatch, line):
+    '''builtins the async agent can't run are refused when the session is built'''
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'child.seq').write_text('WAIT 1s\n')
+    (tmp_path / 'main.seq').write_text('echo hi; hi; 5\n%s\n' %(line))
+    seqreader = SequenceReader(str(tmp_path / 'main.seq'))
+    seqreader.parse_lines()
+    with pytest.raises(SequenceError, match='^%s ' %(line.split(' ')[0])):
+        AsyncSession(AsyncAgent('main'), seqreader, 1)
@@ -0,0 +1,53 @@
+import random
+
+import pytest
+
+import benchmark
+import command
+
+
+SENTINELS = {chr(128): ';', chr(129): ',', chr(130): ' '}
+
+def legacy_shell_args(line):
+    '''legacy args with the escapes of the command resolved, the legacy
+    tokenizer left its sentinels there'''
+    args = benchmark.legacy_make_shellcmd_args_by_line(line)
+    args[0] = ''.join(SENTINELS.get(c, c) for c in args[0])
+    return args
+
+def random_lines(pieces, n=20000, seed=11):
+    rand = random.Random(seed)
+    for i in range(n):
+        yield ''.join(rand.choice(pieces) for j in range(rand.randint(0, 12)))
+
+
+@pytest.mark.parametrize('line, args', [
+    ("echo it's done; ok; can't open; 10", ["echo it's done", ('ok',), ("can't open",), ('10',)]),
+    ('echo "a;b"; ok', ['echo "a', ('b"',), ('ok',)]),
+    ('echo a\\;b; ok\\, done, 0x1; fail\\ ; 30', ['echo a;b', ('ok, done', '0x1'), ('fail ',), ('30',)]),
+    ])
+def test_shell_args(line, args):
+    assert command.make_shellcmd_args_by_line(line) == args
+
+
+@pytest.mark.parametrize('name, pieces', [
+    ('escaped', ['a', 'b c', ' ', ';', ',', '\\;', '\\,', '\\ ', '\\', 'x\\']),
+    ('quoted', ['echo', ' ', '"', '"a;b"', ';', ',', 'x', '\\;']),
+    ('apostrophe', ["it's", "can't", "'", ' ', ';', ',', 'ok', '\\ ']),
+    ])
+def test_shell_tokenizer_matches_legacy(name, pieces):
+    '''the one scan tokenizer splits shell lines as the sentinel one did'''
+    for line in random_lines(pieces):
+        assert command.make_shellcmd_args_by_line(line) == legacy_shell_args(line), repr(line)
+
+
+@pytest.mark.parametrize('name, pieces', [
+    ('escaped', ['a', ' ', ' ', '\\', '\\ ', 'b\\', '\n']),
+    ('quoted', ['"', '"a b"', ' ', '\\ ', 'x']),
+    ('apostrophe', ["it's", "'", ' ', '\\ ', 'x']),
+    ])
+def test_builtin_tokenizer_matches_legacy(name, pieces):
+    '''builtin lines split on spaces as the sentinel tokenizer did'''
+    for line in random_lines(pieces):
+        assert command.make_bltincmd_args_by_line(line) == \
+            benchmark.legacy_make_bltincmd_args_by_line(line), repr(line)
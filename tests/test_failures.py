@@ -0,0 +1,34 @@
+from failures import FailureHistory, FailureSignatures
+
+
+def test_stores_of_one_minute_are_kept(tmp_path):
+    '''histories named alike spill to stores of their own, never over an existing file'''
+    (tmp_path / 'Jan-01-0000-2026_main_failure_old.db').write_text('kept')
+    histories = [FailureHistory(str(tmp_path), 'Jan-01-0000-2026_main_failure_', window=2) for i in range(2)]
+    for i, history in enumerate(histories):
+        for loop in range(1, 6):
+            history.add(i, loop, ['failure of loop %d' %(loop)])
+    assert histories[0].path != histories[1].path
+    for i, history in enumerate(histories):
+        assert len(history) == 5 and history.spilled > 0
+        assert history.loops(i) == [1, 2, 3, 4, 5]
+        history.close()
+    assert (tmp_path / 'Jan-01-0000-2026_main_failure_old.db').read_text() == 'kept'
+
+
+def failure(loop, output):
+    return {'CLASS': 'ExpectFailure', 'DESCRIPTION': 'ExpectFailure: Expects not found: echo %d; ok' %(loop),
+            'COMMAND': 'echo %d: ok' %(loop), 'SESSION': 'local', 'OUTPUT': output, 'INFO': 'loop %d' %(loop)}
+
+
+def test_signatures_of_structured_failures():
+    '''failures differing only in numbers share a signature, fields are never parsed from the text'''
+    signatures = FailureSignatures()
+    first, new = signatures.add(failure(1, 'Session: other, code 0x1f'), 'main', 1)
+    assert new and first.key == ('ExpectFailure', 'ExpectFailure: Expects not found: echo #; ok',
+                                 'echo 1: ok', 'local', 'Session: other, code #')
+    signature, new = signatures.add(failure(1, 'Session: other, code 0x20'), 'main', 2)
+    assert signature is first and not new and signature.count == 2 and signature.last == ('main', 2)
+    signature, new = signatures.add(failure(2, 'Session: other, code 0x20'), 'main', 3)
+    assert new and len(signatures) == 2
+    assert first.failure['INFO'] == 'loop 1'
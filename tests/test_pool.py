@@ -0,0 +1,46 @@
+import pytest
+
+from conftest import run_test
+
+
+@pytest.mark.parametrize('backend', ['process', 'thread'])
+def test_run_with_one_worker_slot(tmp_path, backend):
+    '''a RUN waits for the slot of the worker that queued it, and runs once that worker's sequence ends'''
+    (tmp_path / 'main.seq').write_text('RUN child.seq\nRUN child.seq\nWAIT 1s\n')
+    (tmp_path / 'child.seq').write_text('RUN leaf.seq\nWAIT 1s\n')
+    (tmp_path / 'leaf.seq').write_text('WAIT 1s\n')
+    output = run_test(str(tmp_path), '-f', 'main.seq', '-w', '1', '-b', backend)
+    summary = output.split('RESULT SUMMARY:')[-1]
+    assert summary.count('>> Total loops: 1, 1 loops PASSED, 0 loops FAILED') == 5, output
+    assert summary.count('* Sequence [leaf]') == 2, output
+
+
+@pytest.mark.parametrize('backend', ['process', 'thread'])
+def test_run_in_shards(tmp_path, backend):
+    '''RUNs in shards don't starve for slots, and are merged across shards'''
+    (tmp_path / 'main.seq').write_text('RUN child.seq\nWAIT 1s\n')
+    (tmp_path / 'child.seq').write_text('WAIT 1s\n')
+    output = run_test(str(tmp_path), '-f', 'main.seq', '-l', '4', '-k', '2', '-w', '1', '-b', backend)
+    assert '* Sequence [main] of 2 shards>> Total loops: 4, 4 loops PASSED' in output, output
+    assert '* Sequence [child] of 2 shards>> Total loops: 4, 4 loops PASSED' in output, output
+
+
+@pytest.mark.parametrize('backend', ['process', 'thread'])
+def test_shell_commands_in_workers(tmp_path, backend):
+    '''workers run shell commands with the tool's own modules, wherever they are started from'''
+    (tmp_path / 'main.seq').write_text('echo hello; hello; 5\nRUN child.seq\n')
+    (tmp_path / 'child.seq').write_text('echo child; child; 5\n')
+    output = run_test(str(tmp_path), '-f', 'main.seq', '-b', backend)
+    assert '* Sequence [main]>> Total loops: 1, 1 loops PASSED' in output, output
+    assert '* Sequence [child]>> Total loops: 1, 1 loops PASSED' in output, output
+
+
+@pytest.mark.parametrize('backend', ['process', 'thread'])
+def test_targets_in_workers(tmp_path, backend):
+    '''each shard's shells, and those of the workers it RUNs, get the shard's target'''
+    check = 'test "$AUTOSEQ_TARGET" = a -o "$AUTOSEQ_TARGET" = b && echo on-target; on-target; 5\n'
+    (tmp_path / 'main.seq').write_text(check + 'RUN child.seq\n')
+    (tmp_path / 'child.seq').write_text(check)
+    output = run_test(str(tmp_path), '-f', 'main.seq', '-l', '2', '-t', 'a,b', '-b', backend)
+    assert '* Sequence [main] of 2 shards>> Total loops: 2, 2 loops PASSED' in output, output
+    assert '* Sequence [child] of 2 shards>> Total loops: 2, 2 loops PASSED' in output, output
@@ -0,0 +1,23 @@
+import os
+import time
+
+from reactor import Reactor
+
+
+def test_wait_readable():
+    '''a wait ends when the fd gets readable, or times out without burning the CPU'''
+    reactor = Reactor()
+    r, w = os.pipe()
+    try:
+        reactor.register(r)
+        t_start, cpu_start = time.monotonic(), time.process_time()
+        assert not reactor.wait_readable(r, 0.2)
+        assert time.monotonic() - t_start >= 0.2
+        assert time.process_time() - cpu_start < 0.1
+        os.write(w, b'x')
+        assert reactor.wait_readable(r, 0.0)
+        assert reactor.wait_readable(r, None)
+    finally:
+        reactor.close()
+        os.close(r)
+        os.close(w)
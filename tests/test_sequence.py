@@ -0,0 +1,45 @@
+import pytest
+
+from conftest import run_test
+
+
+@pytest.mark.parametrize('backend', ['process', 'thread'])
+def test_run_into_subdirectory(tmp_path, backend):
+    '''sequences preloaded from a subdirectory don't move the main sequence there'''
+    (tmp_path / 'lib').mkdir()
+    (tmp_path / 'main.seq').write_text('RUN lib/child.seq\nWAIT 1s\n')
+    (tmp_path / 'lib' / 'child.seq').write_text('RUN leaf.seq\nWAIT 1s\n')
+    (tmp_path / 'lib' / 'leaf.seq').write_text('WAIT 1s\n')
+    output = run_test(str(tmp_path), '-f', 'main.seq', '-b', backend)
+    assert 'Error' not in output, output
+    for name in ('main', 'child', 'leaf'):
+        assert '* Sequence [%s]>> Total loops: 1, 1 loops PASSED' %(name) in output, output
+
+
+def test_stream_buffers_referred_subsequences(tmp_path):
+    '''streaming yields the commands of a full parse, and buffers only the subsequences LOOP refers to'''
+    import sequence
+    path = tmp_path / 'main.seq'
+    path.write_text('echo start\n'
+                    'SUBSEQUENCE used\necho in used \\\n  continued\nWAIT 1s\nENDSUBSEQUENCE\n'
+                    'SUBSEQUENCE unused\necho never\nENDSUBSEQUENCE\n'
+                    'LOOP used 2\necho end # comment\n')
+    full = sequence.SequenceReader(str(path))
+    full.parse_lines()
+    reader = sequence.SequenceReader(str(path))
+    for lookahead in (1, 64):
+        assert [str(x) for x in reader.stream(lookahead)] == [str(x) for x in full.sequence]
+        assert list(reader.subsequences) == ['used']
+        assert [str(x) for x in reader.subsequences['used']] == [str(x) for x in full.subsequences['used']]
+
+
+def test_cached_run_from_another_directory(tmp_path):
+    '''a cached RUN finds its sequence whatever directory the cache is loaded from'''
+    (tmp_path / 'lib').mkdir()
+    (tmp_path / 'lib' / 'main.seq').write_text('RUN child.seq\nWAIT 1s\n')
+    (tmp_path / 'lib' / 'child.seq').write_text('WAIT 1s\n')
+    cache_home = str(tmp_path / 'cache')
+    for cwd, path in ((tmp_path, 'lib/main.seq'), (tmp_path / 'lib', 'main.seq')):
+        output = run_test(str(cwd), '-f', path, cache_home=cache_home)
+        assert 'Error' not in output, output
+        assert '* Sequence [child]>> Total loops: 1, 1 loops PASSED' in output, output
@@ -0,0 +1,62 @@
+import os
+import socket
+
+import pytest
+
+import uds
+
+
+class ShortSock(object):
+    """Worker connection writing at most size bytes per send, timing out
+    on send number timeout_at"""
+
+    def __init__(self, sock, size, timeout_at=None):
+        self.sock = sock
+        self.size = size
+        self.timeout_at = timeout_at
+        self.sends = 0
+
+    def send(self, data):
+        self.sends += 1
+        if self.sends == self.timeout_at:
+            raise socket.timeout('timed out')
+        return self.sock.send(data[:self.size])
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.mark.parametrize('size, timeout_at', [(1, None), (7, None), (7, 4), (13, 2)])
+def test_frames_written_in_parts(monkeypatch, size, timeout_at):
+    '''the master gets every message once, however the frames are cut'''
+    peers = []
+    def connect(self, t_end):
+        sock, peer = socket.socketpair()
+        peer.setblocking(False)
+        peers.append(peer)
+        self.clientsock = ShortSock(sock, size, timeout_at if len(peers) == 1 else None)
+        self.clientpid = os.getpid()
+        return True
+    monkeypatch.setattr(uds.UDS, 'connect', connect)
+
+    worker = uds.UDS('unused')
+    msgs = [{'MSG': i, 'TEXT': 'x' * i} for i in range(5)]
+    for msg in msgs:
+        worker.send_server_msg(msg, flush=False)
+    worker.flush()
+    assert not worker.outbox and worker.sent == 0
+    assert len(peers) == (2 if timeout_at else 1)
+
+    master = uds.UDS('unused')
+    for peer in peers:      # a frame cut by a dropped connection is discarded
+        master.conns[peer] = bytearray()
+        master.read_conn(peer)
+    assert list(master.inbox) == msgs
+
+
+def test_send_failure_is_reported(monkeypatch, tmp_path):
+    '''a master that can't be reached fails the send with its own error'''
+    monkeypatch.setattr(uds, 'SOCK_RETRY_TIMEOUT', 0.05)
+    worker = uds.UDS(str(tmp_path / 'missing.uds'))
+    with pytest.raises(RuntimeError, match='Send client message failed'):
+        worker.send_server_msg({'MSG': 0})
@@ -4,17 +4,30 @@ import errno
 import time
 import datetime
 import socket
+import selectors
 import re
 import json
+import struct
+import contextvars
 from enum import Enum
+from collections import deque
 import utils
 from globs import *
-from worker import MAX_SEQUENCE_WORKER
 
 # retry timeout for socket
 SOCK_RETRY_TIMEOUT = 90.0
+SOCK_RETRY_BACKOFF = 0.01       # first wait between connect retries, doubled up to the max
+SOCK_RETRY_BACKOFF_MAX = 1.0
+SOCK_RETRY_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOENT,
+                     errno.ECONNREFUSED, errno.ECONNABORTED, errno.ECONNRESET,
+                     errno.EBADF, errno.ENOTCONN, errno.EPIPE)
+FRAME_HEADER = struct.Struct('!I')  # message frame, payload length then JSON payload
+MAX_FRAME_SIZE = 16*1024*1024
+RECV_SIZE = 64*1024
+BATCH_MAX_BYTES = 64*1024       # queued messages are written once this many bytes are queued,
+BATCH_MAX_DELAY = 0.5           # or the oldest of them has waited this long, in seconds
 UNIX_DOMAIN_SOCK = None
-THIS_UDS = None
+THIS_UDS = contextvars.ContextVar('THIS_UDS', default=None)
 
 class MESSAGES(Enum):
     """Signal definitions for workers"""
@@ -29,14 +42,27 @@ class MESSAGES(Enum):
 
 
 class UDS(object):
-    """unix domain socket for ipc class"""
-    def __init__(self):
+    """unix domain socket for ipc class.
+
+    A worker keeps one connection to the master for all its messages, which
+    are JSON payloads prefixed by their length. Queued messages go in one
+    write. The master watches its socket and all connections with one
+    selector, and takes every message that has arrived whenever it wakes."""
+    def __init__(self, path=None):
         global UNIX_DOMAIN_SOCK
-        if THIS_UDS is None:
+        if THIS_UDS.get() is None:
             self.serversock = None
 
-            UNIX_DOMAIN_SOCK = utils.new_uds_name(utils.get_this_seqfile())
+            UNIX_DOMAIN_SOCK = path or utils.new_uds_path(MAIN_SEQUENCE_FILE)
             self.uds = UNIX_DOMAIN_SOCK
+        self.selector = None        # master: watches serversock and the worker connections
+        self.conns = {}             # master: worker connection -> received bytes not framed yet
+        self.inbox = deque()        # master: received messages not consumed yet
+        self.clientsock = None      # worker: connection to the master
+        self.clientpid = None       # process owning clientsock, a forked child connects anew
+        self.outbox = bytearray()   # worker: framed messages not written whole yet
+        self.sent = 0               # worker: bytes of the first frame in outbox already written
+        self.t_batch = None         # worker: when the oldest message in outbox was queued
 
     def init_server_sock(self):
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -46,95 +72,227 @@ class UDS(object):
         except OSError:
             pass
         sock.bind(self.uds)
-        sock.listen(MAX_SEQUENCE_WORKER)
+        sock.listen(WORKER_POOL_SIZE)
+        if self.selector is None:
+            self.selector = selectors.DefaultSelector()
+        elif self.serversock is not None:
+            self.selector.unregister(self.serversock)
+            self.serversock.close()
         self.serversock = sock
+        self.selector.register(sock, selectors.EVENT_READ)
+
+    def accept_conns(self):
+        '''Accept all pending worker connections'''
+        while True:
+            try:
+                conn, addr = self.serversock.accept()
+            except OSError as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if err.errno == errno.ECONNABORTED:
+                    continue
+                raise
+            conn.setblocking(False)
+            self.conns[conn] = bytearray()
+            self.selector.register(conn, selectors.EVENT_READ)
+
+    def drop_conn(self, conn):
+        self.selector.unregister(conn)
+        del self.conns[conn]
+        conn.close()
 
+    def read_conn(self, conn):
+        '''Read what conn has received, queue its complete messages to inbox,
+        return False if the worker has closed the connection'''
+        recved = self.conns[conn]
+        alive = True
+        while True:
+            try:
+                s = conn.recv(RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                s = b''
+            if not s:
+                alive = False
+                break
+            recved += s
+
+        pos = 0
+        while len(recved) - pos >= FRAME_HEADER.size:
+            size, = FRAME_HEADER.unpack_from(recved, pos)
+            if size > MAX_FRAME_SIZE:   # not a frame, the stream is corrupted
+                return False
+            end = pos + FRAME_HEADER.size + size
+            if end > len(recved):
+                break
+            data = utils.STR(recved[pos+FRAME_HEADER.size:end])
+            try:
+                msg = json.loads(data)
+            except ValueError:
+                msg = data
+            self.inbox.append(msg)
+            pos = end
+        del recved[:pos]
+
+        return alive
 
     def recv_client_msg(self):
-        '''Receive a message from the uds sock, blocking'''
+        '''Receive a message from the workers, None if no message has arrived'''
         if DEBUG_MODE_ON:
             return None
 
+        if not self.inbox:
+            self.poll(0)
+
+        return self.inbox.popleft() if self.inbox else None
+
+    def poll(self, timeout=None):
+        '''Wait up to timeout for worker messages, then accept new connections
+        and read all readable ones, return the number of messages received'''
         if not self.serversock:
             self.init_server_sock()
 
-        recved = b''
-        msg = None
+        received = len(self.inbox)
+        for key, events in self.selector.select(timeout):
+            conn = key.fileobj
+            if conn is self.serversock:
+                try:
+                    self.accept_conns()
+                except OSError:
+                    self.init_server_sock()
+            elif conn in self.conns and not self.read_conn(conn):
+                self.drop_conn(conn)
 
-        try:
-            conn, addr = self.serversock.accept()
+        return len(self.inbox) - received
+
+    def close(self):
+        '''Close the server socket and the worker connections'''
+        for conn in list(self.conns):
+            self.drop_conn(conn)
+        if self.serversock:
+            self.selector.unregister(self.serversock)
+            self.serversock.close()
+            self.serversock = None
+        if self.selector:
+            self.selector.close()
+            self.selector = None
+        if self.clientsock:
+            self.clientsock.close()
+            self.clientsock = None
+
+    def connect(self, t_end):
+        '''Connect to the master, retry with exponential backoff until t_end'''
+        wait = SOCK_RETRY_BACKOFF
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(SOCK_RETRY_BACKOFF_MAX)
             try:
-                while True:
-                    try:
-                        s = conn.recv(4096)
-                    except OSError:
-                        s = b''
-
-                    if not s and recved:
-                        try:
-                            msg = json.loads(utils.STR(recved))
-                        except ValueError:
-                            msg = utils.STR(recved)
-                        break   # received a valid message from socket
-
-                    recved = recved + s
-            finally:
-                conn.close()
-
-        except OSError as err:
-            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
-                self.init_server_sock()
-
-        return msg
-
-    def send_server_msg(self, rawmsg):
-        '''Send message to the uds sock'''
-        if DEBUG_MODE_ON:
+                sock.connect(self.uds)
+                sock.settimeout(None)   # blocking writes, a timeout would cut frames
+                self.clientsock = sock
+                self.clientpid = os.getpid()
+                return True
+            except OSError as err:
+                sock.close()
+                # master not listening yet or its backlog is full
+                if err.errno not in SOCK_RETRY_ERRNOS:
+                    raise
+
+            if time.monotonic() + wait > t_end:
+                return False
+            time.sleep(wait)
+            wait = min(wait * 2, SOCK_RETRY_BACKOFF_MAX)
+
+    def write_outbox(self):
+        '''Write all queued messages, reconnecting if the connection drops'''
+        t_end = time.monotonic() + SOCK_RETRY_TIMEOUT
+        while self.outbox:
+            if self.clientsock is not None and self.clientpid != os.getpid():
+                self.clientsock.close()     # our copy of the parent's connection
+                self.clientsock = None
+            if self.clientsock is None and not self.connect(t_end):
+                return False
+            try:
+                with memoryview(self.outbox) as view, view[self.sent:] as data:
+                    self.sent += self.clientsock.send(data)
+                self.drop_sent_frames()
+            except OSError as err:
+                # a frame cut by the drop is discarded by the master, and resent
+                # whole, frames written whole before it are not
+                self.sent = 0
+                self.clientsock.close()
+                self.clientsock = None
+                if not isinstance(err, socket.timeout) and err.errno not in SOCK_RETRY_ERRNOS:
+                    raise
+                if time.monotonic() >= t_end:
+                    return False
+
+        self.t_batch = None
+        return True
+
+    def drop_sent_frames(self):
+        '''Drop the frames written whole from outbox'''
+        pos = 0
+        while self.sent - pos >= FRAME_HEADER.size:
+            size, = FRAME_HEADER.unpack_from(self.outbox, pos)
+            end = pos + FRAME_HEADER.size + size
+            if end > self.sent:
+                break
+            pos = end
+        del self.outbox[:pos]
+        self.sent -= pos
+
+    def flush(self, force=True):
+        '''Write queued messages, if not forced only a batch that is full or old enough'''
+        if not self.outbox:
+            return True
+        if not force and len(self.outbox) < BATCH_MAX_BYTES and \
+                time.monotonic() - self.t_batch < BATCH_MAX_DELAY:
             return True
 
-        if not isinstance(rawmsg, str):
-            msg = json.dumps(rawmsg, ensure_ascii=True)
+        if not self.write_outbox():  # fails sending message
+            error = RuntimeError("Send client message failed: %r" %(bytes(self.outbox[:256])))
+            del self.outbox[:]
+            self.sent = 0
+            import worker   # imports this module
+            this_worker = worker.get_this_worker()
+            if this_worker:
+                this_worker.logging_error(error)
+            raise error
+
+        return True
 
+    def send_server_msg(self, rawmsg, flush=True):
+        '''Send message to the master, or queue it for a later batch if not flush'''
+        if DEBUG_MODE_ON:
+            return True
+
+        msg = rawmsg if isinstance(rawmsg, str) else json.dumps(rawmsg, ensure_ascii=True)
         tosend = utils.BYTES(msg)  # serialize message
         if not tosend:
             return False
 
-        t_end = time.time() + SOCK_RETRY_TIMEOUT
-        sent = False
+        self.outbox += FRAME_HEADER.pack(len(tosend))
+        self.outbox += tosend
+        if self.t_batch is None:
+            self.t_batch = time.monotonic()
 
-        while time.time() <= t_end and not sent:
-            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            try:
-                sock.setblocking(False)
-                sock.connect(self.uds)
-                sock.sendall(tosend)
-                sent = True
-            except OSError as err:
-                # socket fails connecting or resource unavailable
-                if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK,
-                                     errno.ECONNREFUSED, errno.ECONNABORTED,
-                                     errno.EBADF, errno.ENOTCONN, errno.EPIPE):
-                    break
+        return self.flush(flush)
 
-            finally:
-                sock.close()
 
-        if not sent:  # fails sending message
-            if not hasattr(self, 'client_retry'):  # initialize server sock and retry
-                self.client_retry = 1
-                self.init_server_sock()
-                self.send_server_msg(rawmsg)
-            else:
-                utils.disable_win_display()
-                this_worker = utils.get_this_worker()
-                error = RuntimeError("Send client message failed: %r" %(tosend))
-                this_worker.logging_error(error)
-                raise error
 
+def set_this_uds(path):
+    '''Use the uds at path, for workers that don't inherit the master's UDS'''
+    THIS_UDS.set(None)
+    this_uds = UDS(path)
+    THIS_UDS.set(this_uds)
+    return this_uds
 
 
 def get_this_uds():
-    global THIS_UDS
-    if THIS_UDS is None:
-        THIS_UDS = UDS()
-    return THIS_UDS
+    this_uds = THIS_UDS.get()
+    if this_uds is None:
+        this_uds = UDS()
+        THIS_UDS.set(this_uds)
+    return this_uds
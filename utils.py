@@ -2,12 +2,10 @@ import os
 import re
 import sys
 import datetime
+import functools
 import subprocess
 from subprocess import Popen, PIPE
 
-import worker
-import sequence
-import uds
 from globs import *
 
 
@@ -26,6 +24,8 @@ def BYTES(text, encoding="utf-8", errors='strict'):
 def STR(text, encoding="utf-8", errors="ignore"):
     if text is None:
         return ''
+    if isinstance(text, memoryview):   # decode views without copying to bytes first
+        return str(text, encoding=encoding, errors=errors)
 
     try:
         return text.decode(encoding, errors=errors)
@@ -56,50 +56,89 @@ def make_cmd_args(cmd):
 
 
 def fix_seqfile_path(filename):
-    """fix given sequence file's path"""
+    """fix given sequence file's path, return it absolute, so parsed and
+    cached RUNs find their sequence from any working directory"""
+    import worker, sequence     # both import this module
     this_worker = worker.get_this_worker()
-    if this_worker and os.sep not in filename:
-        this_seqfile = this_worker.seq_file
+    # relative to the running sequence, or the one being parsed when preloading
+    this_seqfile = this_worker.seq_file if this_worker else sequence.get_this_seqfile()
+    if this_seqfile and os.sep not in filename:
         filename = this_seqfile[:this_seqfile.rfind(os.sep)+1] + filename
     if filename.startswith('.' + os.sep):
         filename = TOPDIR + filename[1:]
 
-    return filename
+    return os.path.abspath(filename)
+
+
+def split_escaped(text, delimiter=' '):
+    """split text by delimiter, '\\' before a delimiter escapes it.
+    Escapes are left in the splits, the text is scanned once by str.split
+    and only splits ending with '\\' are joined back"""
+    splits = text.split(delimiter)
+    if len(splits) == 1 or '\\' + delimiter not in text:
+        return splits
+
+    joined = []
+    carry = None
+    for sp in splits:
+        if carry is not None:
+            sp = carry + sp
+            carry = None
+        if sp[-1:] == '\\':
+            carry = sp + delimiter
+            continue
+        joined.append(sp)
+    if carry is not None:   # a trailing '\\' escapes nothing
+        joined.append(carry[:-len(delimiter)])
+
+    return joined
 
 
 def split_text_by_delimiter(text, delimiter=' '):
     escape = '\\' + delimiter
-    text.replace(escape, chr(128))
-    splits = [x for x in text.split(delimiter) if x]
-    for i, sp in enumerate(splits):
-        splits[i] = sp.replace(chr(128), delimiter)
+    splits = [x.replace(escape, delimiter) for x in split_escaped(text, delimiter) if x]
 
     return splits
 
 
+# marker that a pattern is not a valid regex, and can only be probed as a literal string
+LITERAL = None
+PATTERN_CACHE_SIZE = 1024
+
+@functools.lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_pattern(p, flags=0):
+    """Classify pattern p once per process, return the compiled regex or LITERAL"""
+    try:
+        return re.compile(p, flags)
+    except re.error:
+        return LITERAL
+
+
 def magic_search(p, s, find=False):
     if not p: return -1 if find else False
     # find, return match position
     if find:
         pos = s.find(p)
         if pos < 0:
-            try:
-                pos = re.search(p, s, re.M).start()
-            except:
-                pass
+            rgx = compile_pattern(p, re.M)
+            if rgx is not LITERAL:
+                m = rgx.search(s)
+                if m is not None:
+                    pos = m.start()
         return pos
     # search, return True/False existence
     if p in s: return True
-    try:
-        return (re.search(p, s, re.M | re.I) is not None)
-    except:
-        return False
+    rgx = compile_pattern(p, re.M | re.I)
+    return rgx is not LITERAL and rgx.search(s) is not None
 
 
 # method that strips all ansi escapes.
 def strip_ansi_escapes(text):
     if text and isinstance(text, type('')):
         text = strip_ansi_escapes.ANSI_ESCAPES.sub('', text)
+    elif text and isinstance(text, (bytes, bytearray, memoryview)):
+        if strip_ansi_escapes.ANSI_ESCAPES_B.search(text):  # only copy data with escapes
+            text = strip_ansi_escapes.ANSI_ESCAPES_B.sub(b'', text)
     return text
 # 7-bit C1 ANSI sequences
 strip_ansi_escapes.ANSI_ESCAPES = re.compile(r'''
@@ -113,6 +152,15 @@ strip_ansi_escapes.ANSI_ESCAPES = re.compile(r'''
         [@-~]   # Final byte
     )
 ''', re.VERBOSE)
+strip_ansi_escapes.ANSI_ESCAPES_B = re.compile(BYTES(strip_ansi_escapes.ANSI_ESCAPES.pattern), re.VERBOSE)
+
+
+def get_sequence_name(sequence_file, shard=None):
+    '''name of a sequence worker, reported to the master and used in log names'''
+    name = sequence_file.split(os.sep)[-1].split('.')[0]
+    if shard is not None:
+        name = '%s#%d' %(name, shard)
+    return name
 
 
 def new_log_path(sequence='', suffix=''):
@@ -121,7 +169,7 @@ def new_log_path(sequence='', suffix=''):
     sequence = sequence.split('.')[0]
 
     if magic_search('failure', suffix): base = './log/failure'
-    elif in_search('errordump', suffix): base = './log/errordump'
+    elif magic_search('errordump', suffix): base = './log/errordump'
     else: base = './log'
 
     if suffix: logpath = '%s/%s_%s_%s.log' %(base, now, sequence, suffix)
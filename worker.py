@@ -2,32 +2,45 @@ import sys
 import os
 import time
 import datetime
-from multiprocessing import Value
+import threading
+import contextvars
 
 from agent import AgentWrapper
 from globs import *
 from errors import *
 import utils
-from uds import (get_this_uds,
+from uds import (get_this_uds, set_this_uds,
                  MESSAGES as MSGS)
-from sequence import SequenceReader
+from sequence import (SequenceReader, SequenceStream, LoopInterpreter,
+                      get_parsed_seqreader, preload_sequences)
 import cursor
+from pool import get_this_pool, init_pool, THREAD_CONTEXT, POOL_POLL_INTERVAL
+from spawnserver import start_spawn_server
+from failures import FailureHistory, FailureSignatures
+from stats import (init_stats, set_this_stats, get_this_stats,
+                   SLOT_PASS, SLOT_FAIL, SLOT_LOOP, SLOT_COMMAND)
 
 
-THIS_WORKER = None
+# the running worker, one per process or per thread of the thread backend
+THIS_WORKER = contextvars.ContextVar('THIS_WORKER', default=None)
 WIN_DISPLAY_EN = None
 WIN_REFRESH_INTERVAL = 5.0
-MAX_SEQUENCE_WORKER = 5                     # maxi + mum worker processes
 
 
-class SequenceWorker(object):
+class SequenceWorker(LoopInterpreter):
     """Sequence agent worker class to run sequences, one worker corresponds
     to a specific sequence, parsed from given sequence file."""
 
-    def __init__(self, sequence_file, loops=1):
+    def __init__(self, sequence_file, loops=1, first_loop=1, shard=None, target=None, stats=None, worker_id=None):
+        self.id = worker_id             # unique id of the worker in the test, assigned by its starter
         self.seq_file = sequence_file   # sequence file
-        if LOG_ENABLED:
-            logfile = utils.new_log_path(sequence_file.split(os.sep)[-1])
+        self.stats = stats              # slot of the shared stats table, None to report loops by messages
+        self.shard = shard              # shard index if the test loops are sharded across workers
+        self.target = target            # target this worker is bound to, exported as $AUTOSEQ_TARGET
+        self.name = utils.get_sequence_name(sequence_file, shard)
+        self.first_loop = first_loop    # number of the first test loop this worker runs
+        if LOGGING_ENABLED:
+            logfile = utils.new_log_path(self.name)
             self.logfile = open(logfile, mode='w')  # logging file handler
         else:
             self.logfile = None
@@ -36,12 +49,16 @@ class SequenceWorker(object):
         self.seq_loops = loops          # loop count that we run the sequence
         self.loop_failures = []         # failure info queue for current test loop
         self.uds = get_this_uds()       # unix domain socket for ipc to master
-        self.agent = AgentWrapper(logfile=self.logfile)
-        # read sequence file, to get the sequence of commands
+        # the target is the agent's env, threads of one process share os.environ
+        self.agent = AgentWrapper(logfile=self.logfile, env={TARGET_ENV: target} if target else None)
+        # get the sequence of commands, parsed by the master before forking
         try:
-            seqreader = SequenceReader(sequence_file)
-            seqreader.parse_lines()
-            self.sequence = seqreader.sequence
+            if SEQUENCE_STREAMING:  # or parsed on demand while running
+                seqreader = SequenceReader(sequence_file)
+                self.sequence = SequenceStream(seqreader, STREAM_LOOKAHEAD)
+            else:
+                seqreader = get_parsed_seqreader(sequence_file)
+                self.sequence = seqreader.sequence
             self.subsequences = seqreader.subsequences
         except Exception as error:
             global WIN_DISPLAY_EN
@@ -50,19 +67,35 @@ class SequenceWorker(object):
             self.logging_error(error)
             raise error
         # running arguments that we really use
-        self.running_sequence = self.sequence   # running sequence, by default the whole sequence
-        self.running_loops = self.seq_loops     # running sequence loops
-        self.cmplt_running_loops = 0            # how many loops that has completed
+        self.frames = []                        # loop frames, the bottom one runs the test loops
         self.running_command = 0                # running command running sequence
+        self.command_index = 0                  # commands run in the running test loop
+
+        self.spawned_workers = []               # runs submitted to the pool by current worker
+        self.pool = get_this_pool()             # worker pool shared with the master
+        # set when the worker runs as a thread and is asked to stop
+        self.killed = getattr(threading.current_thread(), 'killed', None)
+
 
-        self.spawned_workers = []               # workers spawned by current worker
+    @property
+    def running_sequence(self):
+        '''sequence of the innermost running loop'''
+        return self.frames[-1].sequence if self.frames else self.sequence
 
+    @property
+    def running_loops(self):
+        return self.frames[0].loops if self.frames else self.seq_loops
+
+    @property
+    def cmplt_running_loops(self):
+        '''test loops completed, nested LOOP iterations are not counted'''
+        return self.frames[0].cmplt_loops if self.frames else 0
 
     def logging_error(self, errorinfo):
         if not self.errordumpfile:
             error_header = '******ERROR DUMP MESSAGE******\n\n'
             error_title = 'TEST SEQUENCE: %s\n\n' %(self.seq_file)
-            errordumpfile = utils.new_log_path(sequence=self.seq_file.split(os.sep)[-1], suffix='errordump')
+            errordumpfile = utils.new_log_path(sequence=self.name, suffix='errordump')
             self.errordumpfile = open(errordumpfile, mode='w')
             self.errordumpfile.write(error_header + error_title)
             self.errordumpfile.flush()
@@ -76,7 +109,8 @@ class SequenceWorker(object):
         # send SEQUENCE COMPLETE message to master
         msg = {
             'MSG': MSGS.worker_run_cmplt.value,
-            'NAME': self.seq_file.split('.')[0],
+            'NAME': self.name,
+            'ID': self.id,
             }
         self.uds.send_server_msg(msg)
         # logging error dump object
@@ -87,7 +121,7 @@ class SequenceWorker(object):
             self.errordump = None
         # close worker agent
         if self.agent:
-            self.agent.close_on_exception()
+            self.agent.exit()
             self.agent = None
         # flush worker logfile stream
         if self.logfile and not self.logfile.closed:
@@ -100,11 +134,12 @@ class SequenceWorker(object):
             self.errordumpfile.close()
             self.errordumpfile = None
         # update global
-        global THIS_WORKER
-        THIS_WORKER = None
+        THIS_WORKER.set(None)
 
     def format_errinfo(self, cmd, error=None):
-        '''format error to error info strings, for concatenating and logging'''
+        '''format error to a failure message for the master, a dict of the
+        failure fields the master builds its signature from, and INFO, the
+        error info strings for concatenating and logging'''
         if type(error) in (ExpectFailure, TimeoutError, BuiltinCmdError):
             errdesc = '%s: ' %(type(error).__name__) + (error.args[0] if error.args else 'NARG')
         else:
@@ -113,15 +148,30 @@ class SequenceWorker(object):
         commandinfo = 'Command: %s' %(cmd if cmd else 'ENTER')
         sessioninfo = 'Session: %s' %(self.agent.this_session)
         sequenceinfo = 'Sequence: %s' %(self.seq_file)
-        loopinfo = 'Loop: %d' %(self.cmplt_running_loops + 1)
-
-        errinfo = utils.concat_text_lines(errdesc, commandinfo, sessioninfo, sequenceinfo, loopinfo)
-
-        return errinfo
+        if self.target:
+            sequenceinfo += ', Target: %s' %(self.target)
+        loopinfo = 'Loop: %d' %(self.first_loop + self.cmplt_running_loops)
+        for frame in self.frames[1:]:
+            loopinfo += ', %s: %d/%d' %(frame.symbol, frame.cmplt_loops + 1, frame.loops)
+
+        lines = [errdesc, commandinfo, sessioninfo, sequenceinfo, loopinfo]
+        output = getattr(error, 'output', None)
+        output = utils.get_text_last_line(output)[:ERROR_OUTPUT_MAX] if output else ''
+        if output:
+            lines.append('Output: %s' %(output))
+
+        return {
+            'CLASS': type(error).__name__,
+            'DESCRIPTION': errdesc,
+            'COMMAND': cmd if cmd else 'ENTER',
+            'SESSION': str(self.agent.this_session),
+            'OUTPUT': output,
+            'INFO': utils.concat_text_lines(*lines),
+            }
 
     def handle_error(self, cmd, error):
         '''handle all incoming errors with corresponding cmd'''
-        errinfo = self.format_errinfo(cmd, error)
+        failure = self.format_errinfo(cmd, error)
         raise_up = False
 
         # expect failure
@@ -139,17 +189,20 @@ class SequenceWorker(object):
             self.logging_error('\nERROR INFO:\n')
             #self.logging_error(traceback.format_exc())
             #self.logging_error(sys.exc_info()[2])
-            self.logging_error(errinfo + '\n')
+            self.logging_error(failure['INFO'] + '\n')
             ttyinfo = 'AGENT INFO:\n' + repr(self.agent)
             self.logging_error(ttyinfo + '\n')
 
         if raise_up:
+            if self.stats:
+                self.stats.loop_failed()
             # send loop failure message to the master to end master sensing
             msg = {
                 'MSG': MSGS.loop_result_fail.value,
-                'NAME': self.seq_file.split('.')[0],
-                'LOOP': self.cmplt_running_loops + 1,
-                'MSGQ': [errinfo, ],
+                'NAME': self.name,
+                'ID': self.id,
+                'LOOP': self.first_loop + self.cmplt_running_loops,
+                'MSGQ': [failure, ],
                 }
             self.uds.send_server_msg(msg)
             self.errordump = error
@@ -158,7 +211,7 @@ class SequenceWorker(object):
         else:
             # we don't stop the process, but append the error string to the loop failure queue, and send ths message queue
             # later to master, which will record these messages.
-            self.loop_failures.append(errinfo)
+            self.loop_failures.append(failure)
 
     def exec_command(self, command):
         '''run single command and handle errors, no matter builtin command or normal shell command'''
@@ -180,88 +233,145 @@ class SequenceWorker(object):
         return result, output
 
 
+    @property
+    def running_loop(self):
+        '''number of the running test loop'''
+        return self.first_loop + self.cmplt_running_loops
+
+    def loop_done(self):
+        '''count the test loop that has run all its commands, report it to the master if it failed'''
+        loop_result = MSGS.loop_result_fail if self.loop_failures else MSGS.loop_result_pass
+        # count the loop in the stats slot, the master only needs failure details
+        if self.stats:
+            if loop_result == MSGS.loop_result_fail:
+                self.stats.loop_failed()
+            else:
+                self.stats.loop_passed()
+        if not self.stats or loop_result == MSGS.loop_result_fail:
+            # send master loop message
+            loop_msg = {
+                'MSG': loop_result.value,
+                'NAME': self.name,
+                'ID': self.id,
+                'LOOP': self.running_loop,
+                'MSGQ': self.loop_failures,
+                }
+            self.uds.send_server_msg(loop_msg, flush=False)    # batched with the next loops'
+        self.command_index = 0
+        self.spawned_workers = []
+        self.loop_failures = []
+
     def run_sequence(self, sequence=None, loops=None):
-        '''run sequence of commands, by default run the whole sequence parsed from the sequence file'''
+        '''run sequence of commands, by default run the whole sequence parsed from the sequence file.
+        Nested LOOPs push frames onto self.frames instead of recursing, the bottom
+        frame runs the test loops reported to the master'''
         # update globals only when we start running sequence
-        global THIS_WORKER
-        THIS_WORKER = self
+        THIS_WORKER.set(self)
 
-        if sequence: self.running_sequence = sequence
-        if loops: self.running_loops = loops
-        self.cmplt_running_loops = 0
-        running_loop = lambda x: (x.cmplt_running_loops + 1)
+        self.frames = []
+        self.push_frame(sequence or self.sequence, loops or self.seq_loops)
+        if not self.frames:
+            return
+        base = self.frames[0]
+        self.command_index = 0      # commands run in the running test loop
+        if self.stats:
+            self.stats.start(self.first_loop)
 
         # loop retry parameters
         test_recovery_retry = TEST_RECOVERY_RETRY   # how many times we can retry running sequence if we see failures or errors
         last_recovery_loop = 0      # last loop we have retried to recovery
 
-        # looping sequence
-        while self.cmplt_running_loops < self.running_loops:
-            # below are loop level parameters
-            self.spawned_workers = []
-            self.loop_failures = []
-            loop_result = MSGS.loop_result_pass
-            cmd_counter = 0
-            # run commands
-            while cmd_counter < len(self.running_sequence):
-                self.running_command = self.running_sequence[cmd_counter]
-                # run this command
-                result, output = self.exec_command(self.running_command)
-                # test need recovery
-                if result == MSGS.test_need_recovery:
-                    loop_result = result
-                    # recovery failed after retry
-                    if test_recovery_retry == 0:
-                        e = RecoveryError('Recovery failed after %r retry at loop %r' %(TEST_RECOVERY_RETRY,
-                                                                                        running_loop(self)))
-                        self.logging_error('\n****************ERROR DUMP END****************\n')
-                        edesc = '\n' + repr(e) + '\n'
-                        self.logging_error(edesc + '\n')
-                        self.stop()
-                        return 0        # exit worker, quit
-
-                    if running_loop(self) == last_recovery_loop:
-                        test_recovery_retry -= 1
-                    else:
-                        last_recovery_loop = running_loop(self)
-                        test_recovery_retry = TEST_RECOVERY_RETRY
-                    # send master a recovery message
-                    recovery_msg = {
-                            'MSG': loop_result.value,
-                            'NAME': self.seq_file.split('.')[0],
-                            'LOOP': running_loop(self),
-                            'MSGQ': self.loop_failures[-1],
-                            }
-                    self.uds.send_server_msg(recovery_msg)
-                    # initialize loop level parameters
-                    for worker in self.spawned_workers:
-                        worker.kill()
-                        time.sleep(0.1)
-                    self.spawned_workers = []
-                    self.loop_failures = []
-                    loop_result = MSGS.loop_result_pass
-                    self.agent.close_tty()  # close tty
-                    cmd_counter = 0         # reset command counter
+        # below are loop level parameters
+        self.spawned_workers = []
+        self.loop_failures = []
+
+        while True:
+            if self.killed is not None and self.killed.is_set():
+                self.stop()
+                return 0    # killed thread worker, quit
+            self.running_command = self.next_command()
+            if self.running_command is None:
+                break
+
+            # run this command
+            if self.stats:
+                self.stats.running(self.running_loop, self.command_index)
+            self.command_index += 1
+            result, output = self.exec_command(self.running_command)
+            self.uds.flush(False)   # write loop messages once the batch is due
+            if self.pool.pending or self.pool.running:
+                self.pool.poll()    # start pending RUNs on freed slots
+            # test need recovery
+            if result == MSGS.test_need_recovery:
+                # recovery failed after retry
+                if test_recovery_retry == 0:
+                    e = RecoveryError('Recovery failed after %r retry at loop %r' %(TEST_RECOVERY_RETRY,
+                                                                                    self.running_loop))
+                    self.logging_error('\n****************ERROR DUMP END****************\n')
+                    edesc = '\n' + repr(e) + '\n'
+                    self.logging_error(edesc + '\n')
+                    self.stop()
+                    return 0        # exit worker, quit
+
+                if self.running_loop == last_recovery_loop:
+                    test_recovery_retry -= 1
                 else:
-                    cmd_counter += 1
-            # send master loop message
-            loop_msg = {
-                'MSG': loop_result.value,
-                'NAME': self.seq_file.split('.')[0],
-                'LOOP': running_loop(self),
-                'MSGQ': self.loop_failures,
-                }
-            self.uds.send_server_msg(loop_msg)
-            # ahead to next loop
-            self.cmplt_running_loops += 1
-
+                    last_recovery_loop = self.running_loop
+                    test_recovery_retry = TEST_RECOVERY_RETRY
+                # send master a recovery message
+                recovery_msg = {
+                        'MSG': result.value,
+                        'NAME': self.name,
+                        'ID': self.id,
+                        'LOOP': self.running_loop,
+                        'MSGQ': self.loop_failures[-1],
+                        }
+                self.uds.send_server_msg(recovery_msg)
+                # initialize loop level parameters
+                for run in self.spawned_workers:
+                    self.pool.kill(run)
+                self.spawned_workers = []
+                self.loop_failures = []
+                self.agent.close_tty()  # close tty
+                # restart this loop from the first command, dropping nested loops
+                del self.frames[1:]
+                base.commands = iter(base.sequence)
+                self.command_index = 0
+
+
+
+class WorkerRecord(object):
+    """State of a sequence worker kept by the master"""
+    __slots__ = ('id', 'name', 'sequence', 'status', 'total_loops', 'success_loops',
+                 'failure_loops', 'spawn_latency', 'slot', 'loop', 'command')
+
+    def __init__(self, worker_id, name, sequence, total_loops, spawn_latency=None, slot=None):
+        self.id = worker_id
+        self.name = name
+        self.sequence = sequence            # sequence of a shard or of a RUN in a shard, merged by it
+        self.status = 'R'                   # 'R' stands for Running, 'C' for Completed
+        self.total_loops = total_loops
+        self.success_loops = 0
+        self.failure_loops = 0
+        self.spawn_latency = spawn_latency  # seconds to start the worker process
+        self.slot = slot                    # stats slot the worker counts its loops in
+        self.loop = 0
+        self.command = 0
 
 
 class MasterWorker(object):
     """Master process, processing sequence workers message and display window output"""
-    def __init__(self):
+    def __init__(self, main_sequence_file=''):
+        self.init_sequence_file = main_sequence_file
         self.failure_logfile = None
-        self.seqworkers = []
+        # failure messages of failed loops, older ones spilled next to the failure log
+        store = utils.new_log_path(sequence=main_sequence_file.split(os.sep)[-1], suffix='failure')
+        self.failures = FailureHistory(os.path.dirname(store),
+                                       os.path.splitext(os.path.basename(store))[0] + '_',
+                                       FAILURE_WINDOW)
+        self.signatures = FailureSignatures()   # distinct failures, logged in full once
+        self.seqworkers = {}    # worker id -> WorkerRecord, in start order
+        self.running = 0        # workers started and not completed yet
         self.uds = get_this_uds()
 
     def logging_failure(self, data):
@@ -276,66 +386,95 @@ class MasterWorker(object):
             self.failure_logfile.write(data)
             self.failure_logfile.flush()
 
+    def format_failures(self, kind, worker, loop, messages):
+        '''log block of a failed loop, a failure's full info is only logged
+        the first time its signature shows up'''
+        if isinstance(messages, dict):
+            messages = [messages]
+        log = '\n%s LOOP: %r, WORKER: %s\n' %(kind, loop, worker.name)
+        for failure in messages:
+            signature, new = self.signatures.add(failure, worker.name, loop)
+            if new:
+                log += 'NEW SIGNATURE #%d:\n%s' %(signature.id, failure['INFO'])
+            else:
+                log += 'SIGNATURE #%d, %d times\n' %(signature.id, signature.count)
+        return log
+
     def update_worker_status(self, msg):
         if not isinstance(msg, dict) or 'NAME' not in msg or 'MSG' not in msg:
             return False
 
-        arriver = msg['NAME']
         signal = msg['MSG']
+        worker_id = msg.get('ID')
+        if worker_id is None:   # worker started without a stats table, known by its name
+            worker_id = msg['NAME']
 
-        updated = False
-        for worker in self.seqworkers:
-            # sequence workers that has started
-            if arriver == worker['NAME']:
-                if signal == MSGS.worker_run_cmplt.value:
-                    worker['STATUS'] = 'C'          # 'C' stands for Completed
-                elif signal == MSGS.test_need_recovery.value:
-                    errorlog = '\nERROR LOOP: %r \nERROR MESSAGE:\n' %(msg['LOOP'])
-                    for elog in msg['MSGQ']:
-                        errorlog = errorlog + elog + '\n'
-                    self.logging_failure(errorlog)
-                elif signal == MSGS.loop_result_fail.value:
-                    worker['FAILURE-LOOPS'] += 1
-                    failureinfo = { msg['LOOP']: msg['MSGQ'] }
-                    worker['FAILURE-MESSAGES'].update(failureinfo)
-                    failurelog = '\nFAILURE LOOP: %r \nFAILURE MESSAGES:\n' %(msg['loop'])
-                    for flog in msg['MSGQ']:
-                        failurelog = failurelog + flog + '\n'
-                    self.logging_failure(failurelog)
-                else:
-                    worker['SUCCESS-LOOPS'] += 1    # loop pass
-
-                updated = True
+        worker = self.seqworkers.get(worker_id)
         # new sequence workers
-        if not updated:
+        if worker is None:
             if signal != MSGS.worker_run_start.value:
                 raise RuntimeError('Invalid worker message received: %r' %(signal))
 
-            if len(self.seqworkers) >= MAX_SEQUENCE_WORKER:
-                raise RuntimeError('Too many sequences started, maximum: %r' %(MAX_SEQUENCE_WORKER))
-
-            worker = {
-                'NAME': arriver,
-                'FAILURE-LOOPS': 0,
-                'SUCCESS-LOOPS': 0,
-                'TOTAL-LOOPS': msg['LOOPS'],
-                'FAILURE-MESSAGES': {},
-                'STATUS': 'R',  # 'R' stands for Running
-                }
-            self.seqworkers.append(worker)
+            slot = msg.get('ID') if get_this_stats().has_slot(msg.get('ID')) else None
+            worker = WorkerRecord(worker_id, msg['NAME'], msg.get('SEQUENCE'),
+                                  msg['LOOPS'], msg.get('SPAWN'), slot)
+            self.seqworkers[worker_id] = worker
+            self.running += 1
+        # sequence workers that has started
+        elif signal == MSGS.worker_run_start.value:
+            pass                                # a worker without id started again
+        elif signal == MSGS.worker_run_cmplt.value:
+            if worker.status == 'R':
+                worker.status = 'C'             # 'C' stands for Completed
+                self.running -= 1
+        elif signal == MSGS.test_need_recovery.value:
+            self.logging_failure(self.format_failures('ERROR', worker, msg['LOOP'], msg['MSGQ']))
+        elif signal == MSGS.loop_result_fail.value:
+            if worker.slot is None:
+                worker.failure_loops += 1
+            self.failures.add(worker.id, msg['LOOP'], msg['MSGQ'])
+            self.logging_failure(self.format_failures('FAILURE', worker, msg['LOOP'], msg['MSGQ']))
+        elif worker.slot is None:
+            worker.success_loops += 1           # loop pass
 
         return True
 
+    def read_stats(self):
+        '''update the loop counters of workers counting in the stats table'''
+        stats = get_this_stats()
+        for worker in self.seqworkers.values():
+            if worker.slot is not None:
+                fields = stats.read(worker.slot)
+                worker.success_loops = int(fields[SLOT_PASS])
+                worker.failure_loops = int(fields[SLOT_FAIL])
+                worker.loop = int(fields[SLOT_LOOP])
+                worker.command = int(fields[SLOT_COMMAND])
+
     def some_worker_running(self):
-        return any(w['STATUS'] == 'R' for w in self.seqworkers)
+        return self.running > 0
 
 
 
 ###############################################################################
 # ********************** MULTIPROCESSING **************************************
 ###############################################################################
-def run_sequence_worker(sequence_file, sequence_loops):
-    job = SequenceWorker(sequence_file, sequence_loops)
+def run_sequence_worker(sequence_file, sequence_loops, win_display=None, shard=None, target=None, stats=None):
+    '''run a sequence worker, shard is (shard index, first loop) when the test
+    loops are sharded, target is exported to the worker's shells, stats is
+    (stats table, worker id), the worker counts its loops in the id's slot'''
+    global WIN_DISPLAY_EN
+    if win_display is not None:     # workers from the spawn server don't inherit it
+        WIN_DISPLAY_EN = win_display
+    if WORKER_BACKEND == 'thread':
+        # threads share the process, but not the socket object of their starter
+        set_this_uds(get_this_uds().uds)
+    shard, first_loop = shard if shard else (None, 1)
+    stats, worker_id = stats if stats else (None, None)
+    slot = None
+    if stats is not None:
+        set_this_stats(stats)   # for the workers this one starts
+        slot = stats.slot(worker_id)
+    job = SequenceWorker(sequence_file, sequence_loops, first_loop, shard, target, slot, worker_id)
     if job.logfile and not job.logfile.closed:
         line = '*************SEQUENCE LOGGING***************'
         job.logfile.write(line + '\n\n')
@@ -358,95 +497,182 @@ def run_sequence_worker(sequence_file, sequence_loops):
         line = 'Test sequence completed successfully...'
         job.logfile.write('\n\n' + line + '\n')
         job.logfile.flush()
+    # the sequence has ended, its slot goes to the RUNs still waiting for
+    # one, all are started before the master is told this worker completed
+    pool = get_this_pool()
+    pool.release()
+    pool.start_pending()
     # job completes
     job.stop()
+    pool.drain()
+
+
+def shard_loops(loops, shards):
+    '''split loops 1..loops into shards contiguous ranges, return [(first loop, loops)]'''
+    shards = max(min(shards, loops), 1)
+    size, extra = divmod(loops, shards)
+    ranges = []
+    first = 1
+    for i in range(shards):
+        n = size + (1 if i < extra else 0)
+        ranges.append((first, n))
+        first += n
+    return ranges
 
 
 # ********************** PROGRAM MAIN ENTRY **********************************
-def start_master(main_sequence_file, main_sequence_loops=1):
+def start_master(main_sequence_file, main_sequence_loops=1, shards=1, targets=()):
     global WIN_DISPLAY_EN
-    master = MasterWorker()
+    master = MasterWorker(main_sequence_file)
+    if WORKER_BACKEND == 'thread':
+        # workers are threads of the master, sharing its parsed sequences
+        context = THREAD_CONTEXT
+        if not SEQUENCE_STREAMING:
+            preload_sequences(main_sequence_file)
+    else:
+        # workers are forked from the spawn server, which parses the sequences once for all
+        context = start_spawn_server(main_sequence_file)
     # enable window display
     if WIN_DISPLAY_EN is None:
-        WIN_DISPLAY_EN = Value('b', 1)
+        WIN_DISPLAY_EN = context.Value('b', 1)
     else:
         WIN_DISPLAY_EN.value = 1
 
-    # START THE MAIN WORKER
-    mainworker = Process(target=run_sequence_worker, args=(main_sequence_file,
-                                                           main_sequence_loops,))
-    mainworker.start()
-    message = {
-        'MSG': MSGS.worker_run_start.value,
-        'NAME': main_sequence_file.split('.')[0],
-        'LOOPS': main_sequence_loops,
-        }
-    master.update_worker_status(message)
+    stats = init_stats(MAX_STATS_SLOTS, context)
+    # START THE MAIN WORKER, or one per shard of the test loops
+    if targets:
+        shards = len(targets)
+    ranges = shard_loops(main_sequence_loops, shards)
+    # all shards run at once, the RUNs they start get the slots an unsharded
+    # test would leave them
+    pool = init_pool(WORKER_POOL_SIZE + len(ranges) - 1, context)
+    for i, (first_loop, loops) in enumerate(ranges):
+        shard = (i, first_loop) if len(ranges) > 1 else None
+        target = targets[i] if targets else None
+        worker_id = stats.alloc()
+        def notify_start(run, shard=shard, loops=loops, worker_id=worker_id):
+            message = {
+                'MSG': MSGS.worker_run_start.value,
+                'NAME': utils.get_sequence_name(main_sequence_file, shard[0] if shard else None),
+                'SEQUENCE': utils.get_sequence_name(main_sequence_file),
+                'LOOPS': loops,
+                'SPAWN': run.spawn_latency,
+                'ID': worker_id,
+                }
+            master.update_worker_status(message)
+        pool.submit(run_sequence_worker,
+                    (main_sequence_file, loops, WIN_DISPLAY_EN, shard, target, (stats, worker_id)),
+                    on_start=notify_start)
 
     this_uds = get_this_uds()
     t_start = time.time()   # process starting time
-    # window display refresh
+    t_redraw = time.monotonic()     # when the window is due for redrawing
+    cursor_lines = 0                # lines of the window drawn last
+    # the master sleeps in the uds selector, woken by worker messages, the
+    # window redraw timer or the pool's polling interval if runs are pending
     while WIN_DISPLAY_EN.value > 0:
-        # process incoming message
-        master.update_worker_status(this_uds.recv_client_msg())
+        timeout = max(t_redraw - time.monotonic(), 0.0)
+        if pool.pending or pool.running:
+            timeout = min(timeout, POOL_POLL_INTERVAL)
+        this_uds.poll(timeout)
+        # process all messages that have arrived
+        while master.update_worker_status(this_uds.recv_client_msg()): pass
+        pool.poll()
 
-        window_header = '\n\nRUNNING WORKERS: %d \n' %(len(master.seqworkers))
-        time_consume = str(datetime.timedelta(seconds=int(time.time() - t_start)))
-        window_display = window_header + 'TIME CONSUME: %s\n\n' %(time_consume)
-        cursor_lines = 5
         # quit everything if all test workers exit
-        if not master.some_worker_running:
+        if not master.some_worker_running() and not pool.pending:
             # handle all buffered messages
             while master.update_worker_status(this_uds.recv_client_msg()): pass
-            if this_uds.serversock:
-                this_uds.serversock.close()
-                this_uds.serversock = None
+            this_uds.close()
             WIN_DISPLAY_EN.value = 0
+        elif time.monotonic() < t_redraw:
+            continue
 
+        t_redraw = time.monotonic() + WIN_REFRESH_INTERVAL
+        master.read_stats()
+        window_header = '\n\nRUNNING WORKERS: %d \n' %(len(master.seqworkers))
+        time_consume = str(datetime.timedelta(seconds=int(time.time() - t_start)))
+        window_display = window_header + 'TIME CONSUME: %s\n\n' %(time_consume)
         # update window display
-        for worker in master.seqworkers:
-            success_loops = worker['SUCCESS-LOOPS']
-            failure_loops = worker['FAILURE-LOOPS']
+        for worker in master.seqworkers.values():
+            success_loops = worker.success_loops
+            failure_loops = worker.failure_loops
             window_display = window_display + \
-                '* Worker [%s]: %d total loops, %d loops PASS, %d loops FAIL ...\n' %(worker['NAME'],
-                                                                                    worker['TOTAL-LOOPS'],
-                                                                                    success_loops,
-                                                                                    failure_loops)
-            cursor_lines += 1
+                '* Worker [%s]: %d total loops, %d loops PASS, %d loops FAIL' %(worker.name,
+                                                                              worker.total_loops,
+                                                                              success_loops,
+                                                                              failure_loops)
+            if worker.slot is not None and worker.status == 'R':
+                window_display += ', running loop %d command %d' %(worker.loop, worker.command + 1)
+            window_display += ' ...\n'
 
         # refresh window display lines
+        if cursor_lines:
+            cursor.erase_lines_upward(cursor_lines)
         sys.stdout.write(window_display)
         sys.stdout.flush()
-        time.sleep(WIN_REFRESH_INTERVAL)
-
-        if WIN_DISPLAY_EN.value > 0:
-            cursor.erase_lines_upward(cursor_lines)
+        cursor_lines = 5 + len(master.seqworkers)
     # display window summary when test completes
+    master.read_stats()
     window_summary_display = '\nRESULT SUMMARY:\n\n'
-    for worker in master.seqworkers:
-        success_loops = worker['SUCCESS-LOOPS']
-        failure_loops = worker['FAILURE-LOOPS']
+    for worker in master.seqworkers.values():
+        success_loops = worker.success_loops
+        failure_loops = worker.failure_loops
         window_summary_display = '\n' + window_summary_display + \
-            '* Sequence [%s]>> Total loops: %d, %d loops PASSED, %d loops FAILED\n' %(worker['NAME'],
+            '* Sequence [%s]>> Total loops: %d, %d loops PASSED, %d loops FAILED\n' %(worker.name,
                                                                                      success_loops+failure_loops,
                                                                                      success_loops,
                                                                                      failure_loops)
-        if worker['FAILURE-MESSAGES']:
+        failures = master.failures.loops(worker.id)
+        if failures:
             window_summary_display += 'FAILURE LOOPS: '
-            window_summary_display += ', '.join([str(x) for x in worker['FAILURE-MESSAGES'].keys()])
+            window_summary_display += ', '.join([str(x) for x in failures])
         window_summary_display += '\n'
 
+    # merge the results of sharded sequences
+    groups = {}
+    for worker in master.seqworkers.values():
+        if worker.sequence is not None:
+            groups.setdefault(worker.sequence, []).append(worker)
+    for name, shards in groups.items():
+        if len(shards) < 2:
+            continue
+        success_loops = sum(w.success_loops for w in shards)
+        failure_loops = sum(w.failure_loops for w in shards)
+        window_summary_display += \
+            '\n* Sequence [%s] of %d shards>> Total loops: %d, %d loops PASSED, %d loops FAILED\n' %(name,
+                                                                                                 len(set(w.name for w in shards)),
+                                                                                                 success_loops+failure_loops,
+                                                                                                 success_loops,
+                                                                                                 failure_loops)
+        failures = sorted(loop for w in shards for loop in master.failures.loops(w.id))
+        if failures:
+            window_summary_display += 'FAILURE LOOPS: ' + ', '.join([str(x) for x in failures]) + '\n'
+
+    if master.signatures:
+        signatures = master.signatures.report()
+        window_summary_display += '\nFAILURE SIGNATURES: %d distinct\n' %(len(master.signatures)) + signatures
+        master.logging_failure('\n\n********FAILURE SIGNATURES********\n\n' + signatures)
+
+    latencies = [w.spawn_latency for w in master.seqworkers.values() if w.spawn_latency is not None]
+    if latencies:
+        window_summary_display += '\nWORKER SPAWN LATENCY: %d workers, avg %.1f ms, max %.1f ms\n' \
+            %(len(latencies), sum(latencies) * 1e3 / len(latencies), max(latencies) * 1e3)
+
     sys.stdout.write(window_summary_display)
     sys.stdout.write('\nFailure log dumped to: %s\n\n' %(master.failure_logfile.name if master.failure_logfile else 'NA'))
+    if master.failures.spilled:
+        sys.stdout.write('Failure history stored in: %s\n\n' %(master.failures.path))
     sys.stdout.flush()
+    master.failures.close()
     if master.failure_logfile and not master.failure_logfile.closed:
         master.failure_logfile.flush()
         master.failure_logfile.close()
     # Remove unix domain sock file
-    if UNIX_DOMAIN_SOCKET:
-        os.remove(UNIX_DOMAIN_SOCKET)
+    if this_uds.uds and os.path.exists(this_uds.uds):
+        os.remove(this_uds.uds)
 
 
 
 def get_this_worker():
-    return THIS_WORKER
+    return THIS_WORKER.get()